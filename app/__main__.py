@@ -1,4 +1,5 @@
 import sys
+import multiprocessing
 
 from PySide2.QtGui import QIcon, QColor, QPalette
 from PySide2.QtCore import QFile, QTextStream, Qt
@@ -10,6 +11,11 @@ from .ui import resources_rc
 
 
 def main():
+    # Worker processes (e.g. discordiaAgeMC, arar.reducePackage) relaunch the
+    # executable in a frozen build, this hands them over to multiprocessing
+    # instead of starting another GUI
+    multiprocessing.freeze_support()
+
     #QGuiApplication.setAttribute(Qt.AA_EnableHighDpiScaling)
     QGuiApplication.setAttribute(Qt.AA_UseHighDpiPixmaps)
     QGuiApplication.setAttribute(Qt.AA_Use96Dpi)
@@ -0,0 +1,437 @@
+'''
+Ar-Ar step heating calculations.
+
+These work on whole columns of a step heating dataset at once and do not
+depend on Qt, so they can be used by the Ar-Ar view and from scripts. J and
+the 40K decay constant are passed as (value, 1 sigma) pairs.
+'''
+
+import numpy as np
+from app.datatypes import Columns
+
+
+def measCov(a, sa, b, sb, ab, sab):
+    ''' Covariance of a and b from the error of their ratio ab (as meas_cov) '''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 0.5*a*b*((sa/a)**2 + (sb/b)**2 - (sab/ab)**2)
+
+
+def stepColumns(df):
+    ''' The 39/40, 36/40 ratios of df with errors and their covariance '''
+    a = np.asarray(df[Columns.Ar39_Ar40], dtype=float)
+    sa = np.asarray(df[Columns.Ar39_Ar40_err], dtype=float)
+    c = np.asarray(df[Columns.Ar36_Ar40], dtype=float)
+    sc = np.asarray(df[Columns.Ar36_Ar40_err], dtype=float)
+    cov = measCov(
+        a, sa, c, sc,
+        np.asarray(df[Columns.Ar39_Ar36], dtype=float),
+        np.asarray(df[Columns.Ar39_Ar36_err], dtype=float)
+    )
+    return (a, sa, c, sc, cov)
+
+
+def stepAges(a, sa, c, sc, cov, J, l, i40_36, full=False):
+    ''' Apparent step ages and their 1 sigma errors
+
+        The errors are propagated to first order with analytic derivatives,
+        as uncertainties does for ArAr.age.
+
+        Parameters:
+        a, sa (array): 39Ar/40Ar and error
+        c, sc (array): 36Ar/40Ar and error
+        cov (array): covariance of 39Ar/40Ar and 36Ar/40Ar
+        J, l, i40_36 (tuple): (value, 1 sigma) of J, the decay constant and
+            the trapped 40Ar/36Ar; the values may also be arrays matching a
+        full (bool): also return the step to step covariance matrix, which
+            comes from J, l and i40_36 being shared by every step
+
+        Returns:
+        tuple: (ages, errors) or (ages, errors, covariance) in units of 1/l
+    '''
+    (J, sJ), (l, sl), (T, sT) = J, l, i40_36
+    with np.errstate(invalid='ignore', divide='ignore'):
+        R = (1 - T*c)/a
+        t = np.log(J*R + 1)/l
+        dtdR = J/(l*(J*R + 1))
+        da = -dtdR*R/a
+        dc = -dtdR*T/a
+        shared = [
+            -dtdR*c/a*sT,
+            R/(l*(J*R + 1))*sJ,
+            -t/l*sl
+        ]
+        var = da**2*sa**2 + dc**2*sc**2 + 2*da*dc*cov
+        if full:
+            V = np.diag(var) + sum(np.outer(g, g) for g in shared)
+            return (t, np.sqrt(np.diag(V)), V)
+        var = var + sum(g**2 for g in shared)
+    return (t, np.sqrt(var))
+
+
+def ages(df, J, l, i40_36, full=False):
+    ''' stepAges for the steps of an Ar-Ar dataset
+
+        Parameters:
+        df (DataFrame): with the 39Ar/40Ar, 36Ar/40Ar and 39Ar/36Ar columns
+            and their errors
+        J, l, i40_36 (tuple or ufloat): J, the decay constant and the trapped
+            40Ar/36Ar with their 1 sigma errors
+    '''
+    pair = lambda v: (v.n, v.s) if hasattr(v, 'std_dev') else tuple(v)
+    return stepAges(*stepColumns(df), pair(J), pair(l), pair(i40_36), full=full)
+
+
+def cumulativeFraction(df):
+    ''' Cumulative 39Ar released (%) at the end of each step '''
+    amount = np.asarray(df[Columns.ArAmount], dtype=float)
+    return 100*np.cumsum(amount)/np.sum(amount)
+
+
+def plateauRanges(n, minSteps):
+    ''' All contiguous (first, last + 1) step ranges with at least minSteps '''
+    return np.triu_indices(n + 1, minSteps)
+
+
+def rangeStats(df, J, l, first, last):
+    ''' Isochron, slope and weighted mean statistics for many step ranges
+
+        Every range [first, last) gets an inverse isochron (36/40 vs 39/40)
+        whose intercept gives the trapped 40/36 for that range. The step ages
+        computed with it are tested for a trend against the mid 39Ar fraction
+        of each step and combined in a weighted mean. All ranges are done at
+        once with segmented sums over the gathered (range, step) pairs.
+
+        Returns:
+        dict: per range arrays 'first', 'last', 'ArPct', 'isoProb', 'i40_36',
+        'i40_36 err', 'slope', 'sigma_slope', 'wmAge', 'wmErr', 'wmMSWD',
+        'wmProb'
+    '''
+    from scipy import stats
+    from app.math import fitLines, segments
+
+    a, sa, c, sc, cov = stepColumns(df)
+    F = cumulativeFraction(df)
+    F0 = np.r_[0, F]
+    mid = F - np.diff(F0)/2
+    first = np.asarray(first, dtype=int)
+    last = np.asarray(last, dtype=int)
+    res = {'first': first, 'last': last, 'ArPct': F0[last] - F0[first]}
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rho = cov/(sa*sc)
+        iso = fitLines(a, sa, c, sc, rho, first, last)
+        ok = iso['converged'] & np.isfinite(iso['prob'])
+        res['isoProb'] = np.where(ok, iso['prob'], np.nan)
+        res['i40_36'] = 1/iso['b']
+        res['i40_36 err'] = iso['sigma_b']/iso['b']**2
+
+        idx, seg, n = segments(first, last)
+        segsum = lambda v: np.add.reduceat(v, seg)
+        rep = lambda v: np.repeat(v, n)
+        t, st = stepAges(
+            a[idx], sa[idx], c[idx], sc[idx], cov[idx], J, l,
+            (rep(res['i40_36']), rep(res['i40_36 err']))
+        )
+
+        # Weighted least squares slope of age vs mid 39Ar fraction
+        w = 1/st**2
+        x = mid[idx]
+        Sw, Swx, Swy = segsum(w), segsum(w*x), segsum(w*t)
+        D = Sw*segsum(w*x*x) - Swx**2
+        res['slope'] = (Sw*segsum(w*x*t) - Swx*Swy)/D
+        res['sigma_slope'] = np.sqrt(Sw/D)
+
+        wm = Swy/Sw
+        mswd = segsum(w*(t - rep(wm))**2)/(n - 1)
+        res['wmAge'] = wm
+        res['wmErr'] = np.sqrt(1/Sw)
+        res['wmMSWD'] = mswd
+        res['wmProb'] = 1 - stats.f.cdf(mswd, n - 1, 1000000000)
+
+    return res
+
+
+def plateauTable(df, J, l, minSteps=2, progress=None, blocks=50):
+    ''' rangeStats for every range of at least minSteps steps, as a DataFrame
+
+        None of the statistics depend on the acceptance criteria, so the Ar-Ar
+        view computes this once per dataset, J and decay constant and applies
+        the criteria with selectPlateau. The ranges are fitted in about
+        `blocks` blocks of whole first steps and progress(percent, message)
+        is called after each, so a caller can show progress or cancel by
+        raising from it.
+    '''
+    import pandas as pd
+
+    report = progress or (lambda p, m: None)
+    first, last = plateauRanges(len(df), minSteps)
+    report(0, f'Fitting {len(first)} ranges')
+    starts = np.flatnonzero(np.r_[True, np.diff(first) != 0])
+    targets = np.linspace(0, len(first), blocks, endpoint=False)
+    bounds = np.unique(np.r_[starts[np.minimum(np.searchsorted(starts, targets), len(starts) - 1)], len(first)])
+    parts = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        parts.append(pd.DataFrame(rangeStats(df, J, l, first[start:stop], last[start:stop])))
+        report(100*stop/len(first), f'Fitted {stop} of {len(first)} ranges')
+    table = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(rangeStats(df, J, l, first, last))
+    table.insert(2, 'steps', table['last'] - table['first'])
+    report(100, 'Done')
+    return table
+
+
+def acceptedRanges(stats, minSteps=3, minArPct=60, minIsoProb=0.15, minWMProb=0.15):
+    ''' Mask of the ranges in a rangeStats result or plateauTable that meet
+        the criteria '''
+    with np.errstate(invalid='ignore'):
+        return np.asarray(
+            (stats['last'] - stats['first'] >= minSteps)
+            & (stats['ArPct'] >= minArPct)
+            & (stats['isoProb'] >= minIsoProb)
+            & (np.abs(stats['slope']) <= np.abs(stats['sigma_slope']))
+            & (stats['wmProb'] >= minWMProb)
+        )
+
+
+def selectPlateau(stats, minSteps=3, minArPct=60, minIsoProb=0.15, minWMProb=0.15):
+    ''' Position of the accepted range with the most 39Ar, or None '''
+    ok = acceptedRanges(stats, minSteps, minArPct, minIsoProb, minWMProb)
+    if not ok.any():
+        return None
+    return int(np.argmax(np.where(ok, stats['ArPct'], -np.inf)))
+
+
+def plateauSweep(table, minSteps=(3,), minArPct=np.arange(50, 101, 5),
+                 minIsoProb=(0.01, 0.05, 0.15), minWMProb=(0.01, 0.05, 0.15), chunk=1024):
+    ''' The plateau selected by every combination of criteria values
+
+        Parameters:
+        table (DataFrame): from plateauTable
+        minSteps, minArPct, minIsoProb, minWMProb (array): values to try
+
+        Returns:
+        DataFrame: one row per combination with the criteria, whether a
+        plateau was found and its range, %39Ar, age and error
+    '''
+    import pandas as pd
+
+    grid = [g.ravel() for g in np.meshgrid(minSteps, minArPct, minIsoProb, minWMProb, indexing='ij')]
+    cols = {c: np.asarray(table[c])[None, :] for c in ('steps', 'ArPct', 'isoProb', 'wmProb')}
+    flat = np.asarray(np.abs(table['slope']) <= np.abs(table['sigma_slope']))[None, :]
+    score = np.where(flat, cols['ArPct'], -np.inf)
+
+    # Combinations x ranges masks, in chunks to bound the memory used
+    best = np.zeros(len(grid[0]), dtype=int)
+    found = np.zeros(len(grid[0]), dtype=bool)
+    for i in range(0, len(grid[0]), chunk):
+        g = [v[i:i + chunk, None] for v in grid]
+        with np.errstate(invalid='ignore'):
+            ok = (
+                (cols['steps'] >= g[0])
+                & (cols['ArPct'] >= g[1])
+                & (cols['isoProb'] >= g[2])
+                & (cols['wmProb'] >= g[3])
+            )
+        s = np.where(ok, score, -np.inf)
+        best[i:i + chunk] = np.argmax(s, axis=1)
+        found[i:i + chunk] = np.isfinite(s.max(axis=1))
+
+    sweep = pd.DataFrame({
+        'minSteps': grid[0],
+        'minArPct': grid[1],
+        'minIsoProb': grid[2],
+        'minWMProb': grid[3],
+        'found': found
+    })
+    for c in ('first', 'last', 'ArPct', 'i40_36', 'wmAge', 'wmErr', 'wmMSWD'):
+        sweep[c] = np.where(found, np.asarray(table[c])[best], np.nan)
+    return sweep
+
+
+def plateau(df, J, l, first, last):
+    ''' Details of the plateau [first, last) in the form the Ar-Ar view uses '''
+    from uncertainties import ufloat, unumpy
+    from app.math import weightedMean
+
+    s = rangeStats(df, J, l, [first], [last])
+    i40_36 = ufloat(s['i40_36'][0], s['i40_36 err'][0])
+    t, st = ages(df[first:last], J, l, i40_36)
+    return {
+        'cf': cumulativeFraction(df)[first:last],
+        'sf': s['ArPct'][0],
+        'ages': unumpy.uarray(t, st),
+        'i40_36': i40_36,
+        'wmage': weightedMean(t, st)
+    }
+
+
+def findPlateau(df, J, l, minSteps=3, minArPct=60, minIsoProb=0.15, minWMProb=0.15, progress=None):
+    ''' The accepted step range with the most 39Ar
+
+        Ranges with less than minArPct of the 39Ar are dropped using the
+        cumulative fractions before any fitting, and the rest are evaluated
+        together by rangeStats.
+
+        Parameters:
+        progress (callable): optional progress(percent, message) callback
+
+        Returns:
+        tuple: ((first, last + 1), %39Ar, plateau dict) or (None, 0, None) if
+        no range meets the criteria
+    '''
+    report = progress or (lambda p, m: None)
+
+    F0 = np.r_[0, cumulativeFraction(df)]
+    first, last = plateauRanges(len(df), minSteps)
+    report(0, f'Checking {len(first)} ranges')
+    keep = F0[last] - F0[first] >= minArPct
+    if not keep.any():
+        return (None, 0, None)
+
+    stats = rangeStats(df, J, l, first[keep], last[keep])
+    report(80, 'Selecting plateau')
+    best = selectPlateau(stats, minSteps, minArPct, minIsoProb, minWMProb)
+    if best is None:
+        return (None, 0, None)
+
+    r = (int(stats['first'][best]), int(stats['last'][best]))
+    report(100, f'Plateau range: {r[0]} to {r[1]}')
+    return (r, stats['ArPct'][best], plateau(df, J, l, *r))
+
+
+def totalGasAge(df, J, l, i40_36):
+    ''' Age from the 39Ar weighted mean 40Ar*/39Ar of all steps
+
+        Returns:
+        tuple: (age, 1 sigma error)
+    '''
+    (J, sJ), (l, sl), (T, sT) = J, l, i40_36
+    a, sa, c, sc, cov = stepColumns(df)
+    amount = np.asarray(df[Columns.ArAmount], dtype=float)
+    w = amount/np.sum(amount)
+
+    R = (1 - T*c)/a
+    dRda = -R/a
+    dRdc = -T/a
+    Rtg = np.sum(w*R)
+    varR = np.sum(w**2*(dRda**2*sa**2 + dRdc**2*sc**2 + 2*dRda*dRdc*cov)) + np.sum(w*c/a)**2*sT**2
+
+    t = np.log(J*Rtg + 1)/l
+    dtdR = J/(l*(J*Rtg + 1))
+    var = dtdR**2*varR + (Rtg/(l*(J*Rtg + 1)))**2*sJ**2 + (t/l)**2*sl**2
+    return (t, np.sqrt(var))
+
+
+def isochronAge(df, J, l):
+    ''' Inverse isochron (36/40 vs 39/40) age and trapped 40/36 of all steps
+
+        Returns:
+        dict: 'age', 'age err' (1 sigma), 'i40_36', 'i40_36 err', 'mswd',
+        'prob'
+    '''
+    from app.math import fitLine
+
+    (J, sJ), (l, sl) = J, l
+    a, sa, c, sc, cov = stepColumns(df)
+    fit = fitLine(a, sa, c, sc, cov/(sa*sc), model=1)
+    m, b = fit['m'], fit['b']
+    cov_mb = -fit['x_bar']*fit['sigma_m']**2
+
+    # 40Ar*/39Ar is the inverse of the 39/40 intercept
+    R = -m/b
+    dRdm = -1/b
+    dRdb = m/b**2
+    varR = dRdm**2*fit['sigma_m']**2 + dRdb**2*fit['sigma_b']**2 + 2*dRdm*dRdb*cov_mb
+
+    t = np.log(J*R + 1)/l
+    dtdR = J/(l*(J*R + 1))
+    var = dtdR**2*varR + (R/(l*(J*R + 1)))**2*sJ**2 + (t/l)**2*sl**2
+    return {
+        'age': t,
+        'age err': np.sqrt(var),
+        'i40_36': 1/b,
+        'i40_36 err': fit['sigma_b']/b**2,
+        'mswd': fit['mswd'],
+        'prob': fit['prob']
+    }
+
+
+def _reduceExperiment(name, df, J, l, i40_36, criteria):
+    summary = {'dataset': name, 'J': J[0], 'J err': J[1], 'steps': len(df), 'error': ''}
+    spectrum = {}
+    try:
+        t, st = ages(df, J, l, i40_36)
+        spectrum = {
+            'fraction': np.r_[0, cumulativeFraction(df)],
+            'age': t,
+            'age err': st
+        }
+
+        r, ArPct, plat = findPlateau(df, J, l, *criteria)
+        if r is not None:
+            summary.update({
+                'plateau first': r[0],
+                'plateau last': r[1],
+                'plateau %39Ar': ArPct,
+                'plateau age': plat['wmage']['internal'][0],
+                'plateau err': plat['wmage']['internal'][1],
+                'plateau mswd': plat['wmage']['mswd'],
+                'plateau prob': plat['wmage']['prob'],
+                'plateau 40/36': plat['i40_36'].n
+            })
+            spectrum['plateau'] = r
+
+        summary['total gas age'], summary['total gas err'] = totalGasAge(df, J, l, i40_36)
+        iso = isochronAge(df, J, l)
+        summary.update({
+            'isochron age': iso['age'],
+            'isochron err': iso['age err'],
+            'isochron 40/36': iso['i40_36'],
+            'isochron 40/36 err': iso['i40_36 err'],
+            'isochron mswd': iso['mswd'],
+            'isochron prob': iso['prob']
+        })
+    except Exception as e:
+        summary['error'] = str(e)
+
+    return (summary, spectrum)
+
+
+def reducePackage(experiments, data=None, l=(0.00055305, 0.00000132), i40_36=(298.56, 0.31),
+                  minSteps=3, minArPct=60, minIsoProb=0.15, minWMProb=0.15, processes=None):
+    ''' Plateau, total gas and inverse isochron ages for many experiments
+
+        Parameters:
+        experiments (dict): dataset name -> J as a ufloat or (value, sigma)
+        data (dict): dataset name -> DataFrame, app.data.datasets if None
+        l, i40_36: decay constant and trapped 40Ar/36Ar (used for the spectra
+            and the total gas ages) with their 1 sigma errors
+        processes (int): worker processes to spread the experiments over (a
+            frozen build relies on the multiprocessing.freeze_support() call
+            in app.__main__.main, scripts need an if __name__ == '__main__'
+            guard)
+
+        Returns:
+        tuple: (summary DataFrame indexed by dataset name, dict of spectra
+        with 'fraction' edges, step 'age' and 'age err' and the 'plateau'
+        range if one was found)
+    '''
+    import pandas as pd
+
+    if data is None:
+        from app.data import datasets as data
+
+    pair = lambda v: (v.n, v.s) if hasattr(v, 'std_dev') else tuple(v)
+    l, i40_36 = pair(l), pair(i40_36)
+    criteria = (minSteps, minArPct, minIsoProb, minWMProb)
+    args = [(name, data[name], pair(J), l, i40_36, criteria) for name, J in experiments.items()]
+
+    if processes and processes > 1 and len(args) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(processes) as ex:
+            out = list(ex.map(_reduceExperiment, *zip(*args)))
+    else:
+        out = [_reduceExperiment(*a) for a in args]
+
+    summary = pd.DataFrame([s for s, _ in out]).set_index('dataset')
+    spectra = {a[0]: sp for a, (_, sp) in zip(args, out)}
+    return (summary, spectra)
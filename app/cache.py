@@ -0,0 +1,111 @@
+'''
+Memoization of view computations.
+
+Views call their numerical routines through results.call(fn, *args, ...).
+The cache key is a hash of the function, the content of any array, Series or
+DataFrame arguments, the other arguments and the current decay constants, so
+restyling a plot reuses the previous fit while any change to the data or the
+fit parameters computes a new one. Entries can be tagged with a dataset name
+and dropped with invalidate(name) when that dataset is edited.
+
+The cache is not thread safe. Background tasks should hand their results
+back to the GUI thread and store() them there.
+'''
+
+from collections import OrderedDict
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+def _update(h, obj):
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        h.update(repr(getattr(obj, 'columns', getattr(obj, 'name', None))).encode())
+        h.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    elif isinstance(obj, np.ndarray):
+        h.update(f'{obj.dtype}{obj.shape}'.encode())
+        if obj.dtype == object:
+            h.update(pd.util.hash_array(obj.ravel()).tobytes())
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (list, tuple)):
+        h.update(f'{type(obj).__name__}{len(obj)}'.encode())
+        for o in obj:
+            _update(h, o)
+    elif isinstance(obj, dict):
+        for k in sorted(obj, key=repr):
+            _update(h, k)
+            _update(h, obj[k])
+    else:
+        h.update(repr(obj).encode())
+
+
+def _constants():
+    try:
+        from app import preferences
+        return tuple(getattr(preferences, k) for k in preferences.__all__)
+    except ImportError:
+        return ()
+
+
+class ResultCache(object):
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+
+    def key(self, fn, *args, **kwargs):
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f'{getattr(fn, "__module__", "")}.{getattr(fn, "__qualname__", repr(fn))}'.encode())
+        _update(h, args)
+        _update(h, kwargs)
+        _update(h, _constants())
+        return h.hexdigest()
+
+    def call(self, fn, *args, tag=None, key=(), **kwargs):
+        ''' Returns fn(*args, **kwargs), computing it only on a cache miss
+
+            tag: dataset name the result depends on, for invalidate()
+            key: extra values that the result depends on but that are not
+                 passed to fn (e.g. properties read by a bound method)
+        '''
+        k = self.key(fn, key, *args, **kwargs)
+        hit, result = self.lookup(k)
+        if not hit:
+            result = fn(*args, **kwargs)
+            self.store(k, result, tag)
+        return result
+
+    def lookup(self, k):
+        ''' (True, result) for a cached key, otherwise (False, None) '''
+        if k in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(k)
+            return (True, self._entries[k])
+
+        self.misses += 1
+        return (False, None)
+
+    def store(self, k, result, tag=None):
+        ''' Caches a result computed elsewhere (e.g. in a worker thread) '''
+        self._entries[k] = result
+        self._entries.move_to_end(k)
+        self._tags[k] = tag
+        while len(self._entries) > self.maxsize:
+            old, _ = self._entries.popitem(last=False)
+            del self._tags[old]
+
+    def invalidate(self, tag=None):
+        ''' Drops the results tagged with tag, or everything if tag is None '''
+        for k in [k for k, t in self._tags.items() if tag is None or t == tag]:
+            del self._entries[k]
+            del self._tags[k]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+results = ResultCache()
@@ -0,0 +1,150 @@
+'''
+²⁰⁷Pb-based common Pb correction.
+
+Each analysis is projected in Tera-Wasserburg space from the common Pb
+composition (0, y0) through the measured (X, Y) onto the concordia. Along the
+curve X = 1/(e^l8t - 1), Y = (e^l5t - 1)/(U85r (e^l8t - 1)) the intersection is
+the root of
+
+    h(t) = (e^l5t - 1)/U85r - y0 (e^l8t - 1) - (Y - y0)/X
+
+with t between 0 and the uncorrected ²⁰⁶Pb/²³⁸U age. The common composition is
+either given or taken from the Stacey and Kramers (1975) model at the corrected
+age, y0 = y0(t), in which case h is solved with y0 updated at every step
+instead of iterating over whole corrections. A coarse grid of ages brackets the
+youngest crossing of every analysis and app.concordia.bracketedNewton refines
+them all at once. With initial ²³⁰Th/²³⁸U or ²³¹Pa/²³⁵U disequilibrium the
+exponential terms are replaced by app.concordia.diseq.
+'''
+
+import numpy as np
+
+
+# Stacey and Kramers (1975) second stage
+SK_T = 3.7e9
+SK_Pb64 = 11.152
+SK_Pb74 = 12.998
+SK_U8Pb4 = 9.74
+
+
+def staceyKramers(t, l238U, l235U, U85r):
+    ''' Stacey-Kramers common ²⁰⁷Pb/²⁰⁶Pb at ages t (years)
+
+    Returns:
+        (y0, dy0/dt)
+    '''
+    t = np.asarray(t, dtype=float)
+    return _staceyKramers(np.exp(l238U*t), np.exp(l235U*t), l238U, l235U, U85r)
+
+
+def _staceyKramers(e8, e5, l238U, l235U, U85r):
+    Pb64 = SK_Pb64 + SK_U8Pb4*(np.exp(l238U*SK_T) - e8)
+    Pb74 = SK_Pb74 + SK_U8Pb4/U85r*(np.exp(l235U*SK_T) - e5)
+    dPb64 = -SK_U8Pb4*l238U*e8
+    dPb74 = -SK_U8Pb4/U85r*l235U*e5
+    return Pb74/Pb64, (dPb74*Pb64 - Pb74*dPb64)/Pb64**2
+
+
+def correct207(X, sX, Y, sY, r=0, common=None, l238U=None, l235U=None, U85r=None, fThU=1, fPaU=1,
+               tol=1e-3, grid=64, chunk=2**16, tmax=4600e6):
+    ''' ²⁰⁷Pb correction of Tera-Wasserburg data
+
+    Parameters:
+        X, sX, Y, sY, r: arrays of measured ²³⁸U/²⁰⁶Pb, ²⁰⁷Pb/²⁰⁶Pb, their
+            1 sigma uncertainties and error correlation
+        common: common ²⁰⁷Pb/²⁰⁶Pb (scalar or array), Stacey-Kramers at the
+            corrected age if None
+        l238U, l235U, U85r: constants, the current preferences if None
+        fThU, fPaU: Th/U and Pa/U fractionation factors, the analyses are
+            projected onto the concordia with initial 230Th and 231Pa
+            disequilibrium (see app.concordia.diseq) if either is not 1
+        tol: tolerance on the ages (years)
+        grid: number of ages searched for a bracket of the youngest crossing
+        chunk: number of analyses searched at a time
+        tmax: uncorrected age above which the grid is searched even if h
+            changes sign only once between 0 and it
+
+    Returns:
+        dict with X and Y (radiogenic ratios), y0 (common ²⁰⁷Pb/²⁰⁶Pb), f206
+        (percent of ²⁰⁶Pb that is common), t and st (corrected ²⁰⁶Pb/²³⁸U age
+        and its 1 sigma uncertainty in years). Analyses without an
+        intersection are nan.
+    '''
+    from app.concordia import bracketedNewton, diseq, table, l230Th, l231Pa
+    if None in (l238U, l235U, U85r):
+        from app import preferences
+        l238U = preferences.l238U if l238U is None else l238U
+        l235U = preferences.l235U if l235U is None else l235U
+        U85r = preferences.U85r if U85r is None else U85r
+
+    X, sX, Y, sY, r = np.broadcast_arrays(*(np.atleast_1d(np.asarray(v, dtype=float)) for v in (X, sX, Y, sY, r)))
+    if common is None:
+        composition = lambda e8, e5, i: _staceyKramers(e8, e5, l238U, l235U, U85r)
+    else:
+        y0 = np.broadcast_to(np.asarray(common, dtype=float), X.shape)
+        composition = lambda e8, e5, i: (y0[i], 0)
+
+    def growth(t):
+        # exp(l t) and the radiogenic 206Pb/238U and 207Pb/235U with their derivatives
+        e8, e5 = np.exp(l238U*t), np.exp(l235U*t)
+        R8 = (e8 - 1, l238U*e8) if fThU == 1 else diseq(t, l238U, fThU, l230Th)
+        R5 = (e5 - 1, l235U*e5) if fPaU == 1 else diseq(t, l235U, fPaU, l231Pa)
+        return e8, e5, R8, R5
+
+    def h(t, i):
+        e8, e5, (R8, dR8), (R5, dR5) = growth(t)
+        y0, dy0 = composition(e8, e5, i)
+        F = R5/U85r - y0*R8 - (Y[i] - y0)/X[i]
+        dF = dR5/U85r - y0*dR8 + dy0*(1/X[i] - R8)
+        return F, dF
+
+    # The corrected age is below the uncorrected one, tm. For a fixed y0 (and
+    # no disequilibrium) h has at most one turning point, so a sign change
+    # between 0 and tm means a single root. Analyses left of the curving old
+    # part of the concordia (no sign change) and very old uncorrected ages
+    # (where the Stacey-Kramers y0(t) can add roots) are bracketed by the
+    # youngest sign change on a grid of ages instead.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tm = np.where(X > 0, table(l238U, l235U, U85r).age68(1/X, fThU), np.nan)
+        idx = np.arange(len(X))
+        up0, upm = h(0*tm, idx)[0] > 0, h(tm, idx)[0] > 0
+        lo = np.where(up0 != upm, 0, np.nan)
+        hi = np.where(up0 != upm, tm, np.nan)
+        s = np.where(up0, -1., 1.)
+        g = np.linspace(0, 1, grid)
+        scan = np.flatnonzero(((up0 == upm) | (tm > tmax)) & np.isfinite(tm))
+        for start in range(0, len(scan), chunk):
+            i = scan[start:start + chunk]
+            tg = tm[i, None]*g
+            up = h(tg, i[:, None])[0] > 0
+            change = up[:, :-1] != up[:, 1:]
+            k = np.argmax(change, axis=1)
+            found = change.any(axis=1)
+            j = np.arange(len(i))
+            lo[i] = np.where(found, tg[j, k], np.nan)
+            hi[i] = np.where(found, tg[j, k + 1], np.nan)
+            s[i] = np.where(up[j, k], -1, 1)
+
+    t = bracketedNewton(lambda t, i: tuple(s[i]*v for v in h(t, i)), lo, hi, tol=tol)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        e8, e5, (R8, _), (R5, _) = growth(t)
+        X2 = 1/R8
+        Y2 = R5/(U85r*R8)
+        y0 = composition(e8, e5, slice(None))[0]*np.ones(len(X))
+        f206 = 100*(Y - Y2)/(y0 - Y2)
+
+        # Implicit derivatives of h(t, X, Y) = 0
+        ht = h(t, slice(None))[1]
+        hX = (Y - y0)/X**2
+        hY = -1/X
+        st = np.sqrt((hX*sX)**2 + (hY*sY)**2 + 2*r*hX*hY*sX*sY)/np.abs(ht)
+
+    return {
+        'X': X2,
+        'Y': Y2,
+        'y0': y0,
+        'f206': f206,
+        't': t,
+        'st': st
+    }
@@ -0,0 +1,247 @@
+'''
+Shared concordia curve tables.
+
+A ConcordiaTable holds the Wetherill and Tera-Wasserburg concordia curves
+(and their time derivatives) on a dense, monotone time grid for one set of
+decay constants. Tables are built once and kept in a small LRU cache keyed by
+(l238U, l235U, U85r), so plots, intercept seeds and single grain ages all use
+the same precomputed arrays. Use table() to get the table for the current
+app.preferences constants.
+'''
+
+from functools import lru_cache
+import numpy as np
+
+l230Th = 9.1705e-6 # Cheng et al. (2013)
+l231Pa = 2.1158e-5 # Robert et al. (1969)
+
+
+class ConcordiaTable(object):
+
+    def __init__(self, l238U, l235U, U85r, tmax=5000e6, step=1e6):
+        self.l238U = l238U
+        self.l235U = l235U
+        self.U85r = U85r
+        self.t = np.arange(0, tmax + step/2, step)
+
+        self.x, self.y = self.wetherill(self.t)
+        self.dx, self.dy = self.wetherillDerivative(self.t)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.X, self.Y = self.tw(self.t)
+            self.dX, self.dY = self.twDerivative(self.t)
+        # Limits of the TW curve as t -> 0
+        self.X[0] = np.inf
+        self.Y[0] = l235U / (l238U * U85r)
+
+        for a in (self.t, self.x, self.y, self.dx, self.dy, self.X, self.Y, self.dX, self.dY):
+            a.flags.writeable = False
+
+    def wetherill(self, t):
+        ''' 207Pb/235U and 206Pb/238U on the concordia at t (years) '''
+        return (np.expm1(self.l235U * t), np.expm1(self.l238U * t))
+
+    def wetherillDerivative(self, t):
+        return (self.l235U * np.exp(self.l235U * t), self.l238U * np.exp(self.l238U * t))
+
+    def tw(self, t):
+        ''' 238U/206Pb and 207Pb/206Pb on the concordia at t (years) '''
+        e8 = np.expm1(self.l238U * t)
+        e5 = np.expm1(self.l235U * t)
+        return (1 / e8, e5 / (self.U85r * e8))
+
+    def twDerivative(self, t):
+        e8 = np.exp(self.l238U * t)
+        e5 = np.exp(self.l235U * t)
+        dX = -self.l238U * e8 / (e8 - 1)**2
+        dY = (self.l235U * e5 * (e8 - 1) - self.l238U * e8 * (e5 - 1)) / (self.U85r * (e8 - 1)**2)
+        return (dX, dY)
+
+    def curve(self, tw, tmin=0, tmax=4600e6):
+        ''' Views of the tabulated curve between tmin and tmax (years) '''
+        s = slice(*np.searchsorted(self.t, [tmin, tmax]))
+        if tw:
+            return (self.t[s], self.X[s], self.Y[s])
+        return (self.t[s], self.x[s], self.y[s])
+
+    def age68(self, r68, fThU=1):
+        ''' Radiogenic 206Pb/238U ratio -> age (years), corrected for an initial
+            230Th/238U disequilibrium if fThU (the Th/U fractionation factor) != 1 '''
+        if fThU == 1:
+            return np.log(np.asarray(r68) + 1) / self.l238U
+        return self.solve(r68, lambda t: diseq(t, self.l238U, fThU, l230Th))
+
+    def age75(self, r75, fPaU=1):
+        ''' Radiogenic 207Pb/235U ratio -> age (years), corrected for an initial
+            231Pa/235U disequilibrium if fPaU != 1 '''
+        if fPaU == 1:
+            return np.log(np.asarray(r75) + 1) / self.l235U
+        return self.solve(r75, lambda t: diseq(t, self.l235U, fPaU, l231Pa))
+
+    def ageTW(self, X):
+        ''' Age from the 238U/206Pb coordinate of the TW concordia '''
+        return np.log(1 / np.asarray(X) + 1) / self.l238U
+
+    def age76(self, r76, fThU=1, fPaU=1, t0=None):
+        ''' Radiogenic 207Pb/206Pb ratio -> age (years)
+
+            With fThU or fPaU != 1 the 206Pb and 207Pb ingrowth includes the
+            initial disequilibrium terms of Sakata (2018, eqs. 1 and 2). The
+            ratio then first falls and then rises with age, so t0 (e.g. the
+            206Pb/238U ages) picks the branch; without it the older branch is
+            used. Ratios outside the tabulated range are clipped to its ends.
+        '''
+        if fThU == 1 and fPaU == 1:
+            return self.solve(r76, self.pb76, table=self.Y)
+
+        def f(t):
+            R68, dR68 = diseq(t, self.l238U, fThU, l230Th)
+            R75, dR75 = diseq(t, self.l235U, fPaU, l231Pa)
+            return R75/(self.U85r*R68), (dR75*R68 - R75*dR68)/(self.U85r*R68**2)
+
+        return self.solve(r76, f, t0=t0)
+
+    def pb76(self, t):
+        ''' Radiogenic 207Pb/206Pb at t and its time derivative '''
+        _, Y = self.tw(t)
+        _, dY = self.twDerivative(t)
+        return Y, dY
+
+    def solve(self, r, f, table=None, t0=None, tol=1e-3, maxiter=50):
+        ''' Ages t at which f(t)[0] = r
+
+            The time grid is split into runs on which f is monotone. The root of
+            every ratio is bracketed between two nodes of the run containing t0
+            (the last run by default), then refined with Newton steps that fall
+            back to bisection when they leave the bracket.
+
+            Parameters:
+                r: array of ratios
+                f: function returning (value, derivative) at an array of times
+                table: f on the time grid, computed if not given
+                t0: array of approximate ages used to choose the run
+                tol: tolerance on the age (years)
+
+            Returns:
+                array of ages clipped to the run, nan where r is nan
+        '''
+        r = np.asarray(r, dtype=float)
+        shape = r.shape
+        r = r.ravel()
+        if table is None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                table = np.array(f(self.t)[0], dtype=float)
+                # f(0) is usually 0/0, use its limit
+                table[0] = f(self.t[1]*1e-9)[0]
+
+        d = np.diff(table)
+        turns = np.flatnonzero(d[1:]*d[:-1] < 0) + 1
+        edges = np.r_[0, turns, len(table) - 1]
+        run = np.full(r.shape, len(edges) - 2)
+        if t0 is not None and len(turns):
+            t0 = np.broadcast_to(np.asarray(t0, dtype=float), shape).ravel()
+            run = np.searchsorted(self.t[turns], t0, side='right')
+
+        t = np.empty_like(r)
+        for j in np.unique(run):
+            s = slice(edges[j], edges[j + 1] + 1)
+            sel = run == j
+            t[sel] = _bracketedNewton(r[sel], f, self.t[s], table[s], np.sign(d[edges[j]]), tol, maxiter)
+
+        return t.reshape(shape)
+
+
+def _bracketedNewton(r, f, grid, table, sign, tol, maxiter):
+    ''' Solves sign*f(t) = sign*r on a grid where sign*table is increasing '''
+    table = sign*table
+    i = np.clip(np.searchsorted(table, sign*r), 1, len(grid) - 1)
+    lo, hi = grid[i - 1].copy(), grid[i].copy()
+    with np.errstate(invalid='ignore'):
+        t = np.clip(np.interp(sign*r, table, grid), lo, hi)
+    below = sign*r <= table[0]
+    above = sign*r >= table[-1]
+    lo[below | above | np.isnan(r)] = np.nan
+
+    def g(t, i):
+        F, dF = f(t)
+        return F - r[i], dF
+
+    t = bracketedNewton(g, lo, hi, t, sign, tol, maxiter)
+    t = np.where(below, grid[0], np.where(above, grid[-1], t))
+    return np.where(np.isnan(r), np.nan, t)
+
+
+def bracketedNewton(f, lo, hi, t=None, sign=1, tol=1e-3, maxiter=50):
+    ''' Roots of many functions at once by safeguarded Newton
+
+        Each root is kept bracketed, Newton steps that leave the bracket are
+        replaced by bisection.
+
+        Parameters:
+            f: function(t, i) returning the values and derivatives of the
+               functions with indices i at t
+            lo, hi: arrays of brackets (nan to skip a function)
+            t: starting points, the middle of the brackets if None
+            sign: 1 if the functions increase through their roots, -1 if they decrease
+            tol: tolerance on the roots
+
+        Returns:
+            array of roots, nan where lo or hi is nan
+    '''
+    lo, hi = np.array(lo, dtype=float), np.array(hi, dtype=float)
+    t = (lo + hi)/2 if t is None else np.array(t, dtype=float)
+    with np.errstate(invalid='ignore'):
+        t = np.where(np.isfinite(t), np.clip(t, lo, hi), (lo + hi)/2)
+    active = np.isfinite(lo) & np.isfinite(hi)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(maxiter):
+            if not active.any():
+                break
+            i = np.flatnonzero(active)
+            ta = t[i]
+            F, dF = f(ta, i)
+            F = sign*F
+            la = np.where(F < 0, ta, lo[i])
+            ha = np.where(F >= 0, ta, hi[i])
+            tn = ta - sign*F/dF
+            tn = np.where(np.isfinite(tn) & (tn > la) & (tn < ha), tn, (la + ha)/2)
+            done = (np.abs(tn - ta) <= tol) | (ha - la <= tol)
+            t[i], lo[i], hi[i] = tn, la, ha
+            active[i] = ~done
+
+    return np.where(np.isfinite(lo) & np.isfinite(hi), t, np.nan)
+
+
+def diseq(t, l, f, ld):
+    ''' Radiogenic Pb/U growth with an initial daughter/parent disequilibrium
+
+        Parameters:
+            t: time (years)
+            l: decay constant of the parent U isotope
+            f: fractionation factor of the intermediate daughter (e.g. (Th/U)mineral / (Th/U)melt)
+            ld: decay constant of the intermediate daughter (230Th or 231Pa)
+
+        Returns:
+            (ratio, d ratio / dt)
+    '''
+    t = np.asarray(t, dtype=float)
+    e = np.exp(l*t)
+    ed = np.exp(-ld*t)
+    R = np.expm1(l*t) - l/ld*(f - 1)*np.expm1(-ld*t)*e
+    dR = l*e + l/ld*(f - 1)*(ld*ed*e + l*(1 - ed)*e)
+    return R, dR
+
+
+@lru_cache(maxsize=4)
+def _table(l238U, l235U, U85r):
+    return ConcordiaTable(l238U, l235U, U85r)
+
+
+def table(l238U=None, l235U=None, U85r=None):
+    ''' The ConcordiaTable for the given (or current preference) constants '''
+    if None in (l238U, l235U, U85r):
+        from app import preferences
+        l238U = preferences.l238U if l238U is None else l238U
+        l235U = preferences.l235U if l235U is None else l235U
+        U85r = preferences.U85r if U85r is None else U85r
+
+    return _table(float(l238U), float(l235U), float(U85r))
@@ -1,4 +1,13 @@
-datasets = {}
+class Datasets(dict):
+    ''' Name -> DataFrame. Derived columns (see app.derived) are brought up
+        to date with the current decay constants when a dataset is accessed. '''
+
+    def __getitem__(self, name):
+        from app.derived import refresh
+        return refresh(dict.__getitem__(self, name))
+
+
+datasets = Datasets()
 
 '''
 Reports is a list of dicts, with dicts like:
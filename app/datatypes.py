@@ -49,6 +49,17 @@ class Columns:
     Pb208_Th232_age = '²⁰⁸Pb/²³²Th age'
     Pb208_Th232_age_err = '²⁰⁸Pb/²³²Th age error'
 
+    Discordance = '²⁰⁶Pb/²³⁸U vs ²⁰⁷Pb/²⁰⁶Pb age discordance (%)'
+
+    # ²⁰⁷Pb-corrected (common Pb removed along a line to the Stacey-Kramers composition)
+    U238_Pb206_207corr = '²⁰⁷Pb-corrected ²³⁸U/²⁰⁶Pb'
+    Pb206_U238_207corr = '²⁰⁷Pb-corrected ²⁰⁶Pb/²³⁸U'
+    Pb207_Pb206_207corr = '²⁰⁷Pb-corrected ²⁰⁷Pb/²⁰⁶Pb'
+    Pb207_Pb206_common = 'Common ²⁰⁷Pb/²⁰⁶Pb'
+    f206 = 'Common ²⁰⁶Pb fraction f206 (%)'
+    Pb206_U238_207corr_age = '²⁰⁷Pb-corrected ²⁰⁶Pb/²³⁸U age'
+    Pb206_U238_207corr_age_err = '²⁰⁷Pb-corrected ²⁰⁶Pb/²³⁸U age error'
+
     # U-Th
     Th232_U238 = '²³²Th/²³⁸U'
     Th232_U238_err = '²³²Th/²³⁸U error'
@@ -58,6 +69,10 @@ class Columns:
     Th230_U238_err = '²³⁰Th/²³⁸U error'
     U234_U238_Th230_U238_corr = '²³⁴U/²³⁸U vs ²³⁰Th/²³⁸U error correlation'
     Th232_U238_U234_U238_corr = '²³²Th/²³⁸U vs ²³⁴U/²³⁸U error correlation'
+    Th230_age = '²³⁰Th age'
+    Th230_age_err = '²³⁰Th age error'
+    U234_U238_initial = 'Initial ²³⁴U/²³⁸U'
+    U234_U238_initial_err = 'Initial ²³⁴U/²³⁸U error'
     Th232_U238_Th230_U238_corr = '²³²Th/²³⁸U vs ²³⁰Th/²³⁸U error correlation'
 
 
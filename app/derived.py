@@ -0,0 +1,211 @@
+'''
+Derived columns.
+
+Each Rule names the columns it needs, the columns it produces and the decay
+constants (app.preferences names) it depends on. compute() applies every rule
+whose inputs are present, in order, so later rules can use the outputs of
+earlier ones, and never overwrites a column that was imported. The columns it
+adds and the constants used are recorded in df.attrs, so refresh() can bring
+them up to date, only when those constants have changed since.
+'''
+
+import numpy as np
+from app.datatypes import Columns
+
+
+class Rule(object):
+
+    def __init__(self, inputs, outputs, fn, constants=()):
+        ''' Parameters:
+                inputs: columns required
+                outputs: columns produced
+                fn: function(df, **constants) returning a dict of output columns
+                constants: names of the app.preferences constants passed to fn
+        '''
+        self.inputs = inputs
+        self.outputs = outputs
+        self.fn = fn
+        self.constants = constants
+
+
+def _inverse(df):
+    x, sx = df[Columns.Pb206_U238], df[Columns.Pb206_U238_err]
+    return {
+        Columns.U238_Pb206: 1/x,
+        Columns.U238_Pb206_err: sx/x**2
+    }
+
+
+def _direct(df):
+    X, sX = df[Columns.U238_Pb206], df[Columns.U238_Pb206_err]
+    return {
+        Columns.Pb206_U238: 1/X,
+        Columns.Pb206_U238_err: sX/X**2
+    }
+
+
+def meas_rho(x, xe, u, ue, v, ve):
+    ''' Error correlation of u and v when x = u/v (or v/u) '''
+    return ((ue / u) ** 2 + (ve / v) ** 2 - (xe / x) ** 2) / (2 * (ue / u) * (ve / v))
+
+
+def _wetherillCorr(df):
+    return {
+        Columns.WetherillErrorCorrelation: meas_rho(
+            df[Columns.Pb207_Pb206], df[Columns.Pb207_Pb206_err],
+            df[Columns.Pb207_U235], df[Columns.Pb207_U235_err],
+            df[Columns.Pb206_U238], df[Columns.Pb206_U238_err])
+    }
+
+
+def _twCorr(df):
+    return {
+        Columns.TWErrorCorrelation: meas_rho(
+            df[Columns.Pb207_U235], df[Columns.Pb207_U235_err],
+            df[Columns.U238_Pb206], df[Columns.U238_Pb206_err],
+            df[Columns.Pb207_Pb206], df[Columns.Pb207_Pb206_err])
+    }
+
+
+def _rbsr(df):
+    ab87Rb = 0.2783
+    ab86Sr = 0.0986
+    r = ab87Rb*df[Columns.RbConc]/(ab86Sr*df[Columns.SrConc])
+    return {
+        Columns.Rb87_Sr86: r,
+        Columns.Rb87_Sr86_err: 0.02*r
+    }
+
+
+def _decayAge(ratio, ratio_err, age, age_err, constant):
+    ''' Rule for t = ln(1 + R)/lambda (in Ma) and its error '''
+    def fn(df, **c):
+        l = c[constant]
+        R, sR = df[ratio], df[ratio_err]
+        return {
+            age: np.log1p(R)/l/1e6,
+            age_err: sR/(l*(1 + R))/1e6
+        }
+    return Rule((ratio, ratio_err), (age, age_err), fn, (constant,))
+
+
+def _pb76Age(df, l238U, l235U, U85r):
+    from app.concordia import table
+    ct = table(l238U, l235U, U85r)
+    R, sR = df[Columns.Pb207_Pb206].values, df[Columns.Pb207_Pb206_err].values
+    t = ct.age76(R)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        st = sR/np.abs(ct.pb76(t)[1])
+    return {
+        Columns.Pb207_Pb206_age: t/1e6,
+        Columns.Pb207_Pb206_age_err: st/1e6
+    }
+
+
+def _commonPb(df, l238U, l235U, U85r):
+    from app.commonpb import correct207
+    r = df[Columns.TWErrorCorrelation].values if Columns.TWErrorCorrelation in df.columns else 0
+    c = correct207(df[Columns.U238_Pb206].values, df[Columns.U238_Pb206_err].values,
+                   df[Columns.Pb207_Pb206].values, df[Columns.Pb207_Pb206_err].values, r,
+                   l238U=l238U, l235U=l235U, U85r=U85r)
+    return {
+        Columns.U238_Pb206_207corr: c['X'],
+        Columns.Pb206_U238_207corr: 1/c['X'],
+        Columns.Pb207_Pb206_207corr: c['Y'],
+        Columns.Pb207_Pb206_common: c['y0'],
+        Columns.f206: c['f206'],
+        Columns.Pb206_U238_207corr_age: c['t']/1e6,
+        Columns.Pb206_U238_207corr_age_err: c['st']/1e6
+    }
+
+
+def _discordance(df):
+    return {
+        Columns.Discordance: 100*(1 - df[Columns.Pb206_U238_age]/df[Columns.Pb207_Pb206_age])
+    }
+
+
+rules = [
+    Rule((Columns.Pb206_U238, Columns.Pb206_U238_err), (Columns.U238_Pb206, Columns.U238_Pb206_err), _inverse),
+    Rule((Columns.U238_Pb206, Columns.U238_Pb206_err), (Columns.Pb206_U238, Columns.Pb206_U238_err), _direct),
+    Rule((Columns.Pb206_U238, Columns.Pb206_U238_err,
+          Columns.Pb207_U235, Columns.Pb207_U235_err,
+          Columns.Pb207_Pb206, Columns.Pb207_Pb206_err), (Columns.WetherillErrorCorrelation,), _wetherillCorr),
+    Rule((Columns.U238_Pb206, Columns.U238_Pb206_err,
+          Columns.Pb207_Pb206, Columns.Pb207_Pb206_err,
+          Columns.Pb207_U235, Columns.Pb207_U235_err), (Columns.TWErrorCorrelation,), _twCorr),
+    Rule((Columns.Sr87_Sr86, Columns.RbConc, Columns.SrConc), (Columns.Rb87_Sr86, Columns.Rb87_Sr86_err), _rbsr),
+    _decayAge(Columns.Pb206_U238, Columns.Pb206_U238_err, Columns.Pb206_U238_age, Columns.Pb206_U238_age_err, 'l238U'),
+    _decayAge(Columns.Pb207_U235, Columns.Pb207_U235_err, Columns.Pb207_U235_age, Columns.Pb207_U235_age_err, 'l235U'),
+    _decayAge(Columns.Pb208_Th232, Columns.Pb208_Th232_err, Columns.Pb208_Th232_age, Columns.Pb208_Th232_age_err, 'l232Th'),
+    Rule((Columns.Pb207_Pb206, Columns.Pb207_Pb206_err), (Columns.Pb207_Pb206_age, Columns.Pb207_Pb206_age_err),
+         _pb76Age, ('l238U', 'l235U', 'U85r')),
+    Rule((Columns.Pb206_U238_age, Columns.Pb207_Pb206_age), (Columns.Discordance,), _discordance),
+    Rule((Columns.U238_Pb206, Columns.U238_Pb206_err, Columns.Pb207_Pb206, Columns.Pb207_Pb206_err),
+         (Columns.U238_Pb206_207corr, Columns.Pb206_U238_207corr, Columns.Pb207_Pb206_207corr,
+          Columns.Pb207_Pb206_common, Columns.f206, Columns.Pb206_U238_207corr_age, Columns.Pb206_U238_207corr_age_err),
+         _commonPb, ('l238U', 'l235U', 'U85r'))
+]
+
+
+def currentConstants():
+    from app import preferences
+    return {k: getattr(preferences, k) for k in preferences.__all__}
+
+
+def compute(df, constants=None, recompute=()):
+    ''' Adds the derived columns the data allow
+
+    Parameters:
+        df: DataFrame, modified in place
+        constants: dict of decay constants, the current preferences if None
+        recompute: derived columns to compute again even though they exist
+
+    Returns:
+        df
+    '''
+    if constants is None:
+        constants = currentConstants()
+
+    record = df.attrs.setdefault('derived', {'columns': [], 'constants': {}})
+    recompute = set(recompute)
+    for rule in rules:
+        stale = recompute.intersection(rule.inputs)
+        todo = [c for c in rule.outputs if c not in df.columns or c in recompute or stale and c in record['columns']]
+        if not todo or not set(rule.inputs).issubset(df.columns):
+            continue
+
+        # Keep going with the other rules if one can't be evaluated (e.g. text columns)
+        try:
+            out = rule.fn(df, **{k: constants[k] for k in rule.constants})
+        except Exception as e:
+            print('Could not compute %s: %s'%(', '.join(todo), e))
+            continue
+
+        for c in todo:
+            df[c] = out[c]
+            if c not in record['columns']:
+                record['columns'].append(c)
+        # Anything depending on a recomputed column is stale too
+        recompute.update(todo)
+
+    record['constants'] = {k: constants[k] for k in constants}
+    return df
+
+
+def refresh(df, constants=None):
+    ''' Recomputes the derived columns of df that depend on constants that
+        have changed since they were computed. Cheap if nothing has. '''
+    record = df.attrs.get('derived')
+    if not record or not record['columns']:
+        return df
+
+    if constants is None:
+        constants = currentConstants()
+
+    changed = {k for k in constants if record['constants'].get(k) != constants[k]}
+    if not changed:
+        return df
+
+    stale = [c for r in rules if changed.intersection(r.constants) for c in r.outputs if c in record['columns']]
+    return compute(df, constants, recompute=stale)
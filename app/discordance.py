@@ -0,0 +1,248 @@
+'''
+Discordance of single grains.
+
+minDistance() finds, for all points at once, the smallest Mahalanobis distance
+from each point to a polyline, and concordiaDistance() refines it on the
+concordia curve itself, so a point is concordant at some confidence level
+exactly when its error ellipse reaches the curve. percentDiscordance() covers the usual age-ratio
+definitions. Both return arrays, and concordant()/discordant masks can be used
+to filter DataFrames directly.
+'''
+
+import numpy as np
+from app.ellipse import scale
+
+
+def minDistance(x, sx, y, sy, r, cx, cy, chunk=2**16):
+    ''' Minimum Mahalanobis distance from points to a polyline
+
+        Every segment is searched: the squared distances to the vertices and
+        the projections onto the segments are quadratic forms in the vertex
+        coordinates, so each chunk of points (sized so the work arrays stay
+        around chunk elements) takes a few matrix products. Searching only
+        the vertices, or every few of them, is not enough when segments are
+        long compared to narrow (strongly correlated) error ellipses, as on
+        the young part of a concordia. The segments next to the nearest one
+        are then searched again directly in the metric of each point, which
+        avoids the rounding of the expanded forms.
+
+    Parameters:
+        x, sx, y, sy, r: arrays of values, 1 sigma uncertainties and correlations
+        cx, cy: vertices of the polyline
+
+    Returns:
+        (d2, s): squared distances and the fractional vertex index of the
+        nearest point on the polyline (e.g. 10.25 is a quarter of the way from
+        vertex 10 to 11)
+    '''
+    x, sx, y, sy, r = np.broadcast_arrays(*(np.atleast_1d(np.asarray(v, dtype=float)) for v in (x, sx, y, sy, r)))
+    cx, cy = np.asarray(cx, dtype=float), np.asarray(cy, dtype=float)
+    ok = np.isfinite(cx) & np.isfinite(cy)
+    vi = np.flatnonzero(ok)
+    cx, cy = cx[ok], cy[ok]
+    M = len(cx)
+
+    # Mahalanobis metric of each point: d2 = a dx^2 + 2 b dx dy + c dy^2
+    w = 1/(1 - r**2)
+    a = w/sx**2
+    b = -w*r/(sx*sy)
+    c = w/sy**2
+
+    def d2(i, px, py):
+        dx = px - x[i]
+        dy = py - y[i]
+        return a[i]*dx**2 + 2*b[i]*dx*dy + c[i]*dy**2
+
+    # Nearest segments. With e the segment from vertex j and A the metric,
+    # the distance at u along it is D_j - 2u e'A(p - v_j) + u^2 e'Ae, where
+    # D_j is the vertex distance without the constant p'Ap (which doesn't
+    # change the argmin). All three are products of the point terms P with
+    # vertex or segment terms. Zero length segments get e'Ae = a + c so that
+    # they reduce to their vertex.
+    n = len(x)
+    idx = np.arange(n)
+    P = np.stack([a, b, c, a*x + b*y, b*x + c*y], axis=1)
+    V = np.stack([cx**2, 2*cx*cy, cy**2, -2*cx, -2*cy])
+    ex, ey = np.diff(cx), np.diff(cy)
+    x0, y0 = cx[:-1], cy[:-1]
+    N = np.stack([-ex*x0, -(ex*y0 + ey*x0), -ey*y0, ex, ey])
+    Q = np.stack([ex**2, 2*ex*ey, ey**2])
+    Q[:, (ex == 0) & (ey == 0)] = [[1], [0], [1]]
+    k = np.zeros(n, dtype=int)
+    step = max(1, chunk // max(M, 1))
+    for i in range(0, n, step):
+        Pi = P[i:i + step]
+        D = Pi @ V
+        if M > 1:
+            num = Pi @ N
+            q = Pi[:, :3] @ Q
+            u = np.clip(num/q, 0, 1)
+            q *= u
+            q -= num
+            q -= num
+            q *= u
+            D = D[:, :-1]
+            D += q
+        k[i:i + step] = np.argmin(D, axis=1)
+
+    # Exact minimum on the nearest segment and its neighbours, in case
+    # rounding in the expanded form picked a neighbour
+    best = d2(idx, cx[k], cy[k])
+    pos = k.astype(float)
+    for j in (k - 1, k, k + 1):
+        valid = (j >= 0) & (j < M - 1)
+        j = np.clip(j, 0, max(M - 2, 0))
+        ex, ey = cx[j + 1] - cx[j], cy[j + 1] - cy[j]
+        px, py = x - cx[j], y - cy[j]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            u = (a*ex*px + b*(ex*py + ey*px) + c*ey*py)/(a*ex**2 + 2*b*ex*ey + c*ey**2)
+        u = np.clip(np.nan_to_num(u), 0, 1)
+        dj = d2(idx, cx[j] + u*ex, cy[j] + u*ey)
+        better = valid & (dj < best)
+        best = np.where(better, dj, best)
+        pos = np.where(better, j + u, pos)
+
+    # Back to the indices of the original vertices (non-finite ones dropped)
+    if M:
+        pos = np.interp(pos, np.arange(M), vi)
+    return best, pos
+
+
+def concordiaDistance(x, sx, y, sy, r, tw=False, tmin=0, tmax=4600e6, ct=None, tyoung=100, spacing=0.02):
+    ''' Minimum Mahalanobis distance from points to the concordia
+
+    Parameters:
+        x, sx, y, sy, r: Wetherill (207/235, 206/238) or TW (238/206, 207/206) data
+        tw: whether the data are Tera-Wasserburg
+        tmin, tmax: part of the curve to consider (years)
+        ct: ConcordiaTable, the one for the current constants if None
+        tyoung: youngest age on the curve after tmin (years). The TW curve
+            runs off to infinity as t -> 0, so it has to start well below the
+            youngest analyses.
+        spacing: length of the chords of the curve in log ratio space, i.e.
+            roughly the relative change of the ratios along each of them
+
+    Returns:
+        (d2, t): squared distances and the ages of the nearest points on the curve
+    '''
+    if ct is None:
+        from app.concordia import table
+        ct = table()
+
+    t, cx, cy = concordiaPolyline(ct, tw, tmin, tmax, tyoung, spacing)
+    d2, s = minDistance(x, sx, y, sy, r, cx, cy)
+    i = np.arange(len(t))
+    ts = np.interp(s, i, t)
+
+    # The minimum on the curve itself, near the nearest point of the
+    # polyline, so the result doesn't carry the small offset of the chords
+    # from the curve. The derivative of d2 along the curve changes sign
+    # there, its root is found by safeguarded Newton with the Gauss-Newton
+    # slope.
+    from app.concordia import bracketedNewton
+    x, sx, y, sy, r = np.broadcast_arrays(*(np.atleast_1d(np.asarray(v, dtype=float)) for v in (x, sx, y, sy, r)))
+    w = 1/(1 - r**2)
+    a, b, c = w/sx**2, -w*r/(sx*sy), w/sy**2
+    curve, derivative = (ct.tw, ct.twDerivative) if tw else (ct.wetherill, ct.wetherillDerivative)
+
+    def slope(t, j):
+        ex, ey = (v - p[j] for v, p in zip(curve(t), (x, y)))
+        dx, dy = derivative(t)
+        g = a[j]*ex*dx + b[j]*(ex*dy + ey*dx) + c[j]*ey*dy
+        h = a[j]*dx**2 + 2*b[j]*dx*dy + c[j]*dy**2
+        return g, h
+
+    def dist(t):
+        ex, ey = (v - p for v, p in zip(curve(t), (x, y)))
+        return a*ex**2 + 2*b*ex*ey + c*ey**2
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tn = bracketedNewton(slope, np.interp(s - 2, i, t), np.interp(s + 2, i, t), ts, tol=1)
+        d0, dn = dist(ts), dist(tn)
+
+    # The polyline value is kept where the curve can't be evaluated (the TW
+    # curve at t = 0)
+    better = dn <= d0
+    d = np.where(better, dn, d0)
+    ok = np.isfinite(d)
+    return np.where(ok, d, d2), np.where(ok & better, tn, ts)
+
+
+def concordiaPolyline(ct, tw=False, tmin=0, tmax=4600e6, tyoung=100, spacing=0.02):
+    ''' Ages and ratios of the concordia at equal steps of log ratio arc length
+
+        The 1 Myr steps of the table are far apart at young ages (the TW
+        curve runs off to infinity) and closer than needed at old ones, so
+        the ages are chosen afresh: the curve is evaluated at fine log-spaced
+        ages and resampled where its arc length in (log x, log y) reaches
+        multiples of spacing. tmin is prepended if it is below tyoung.
+    '''
+    t0 = max(tyoung, tmin)
+    tf = np.geomspace(t0, tmax, 20000)
+    fx, fy = ct.tw(tf) if tw else ct.wetherill(tf)
+    arc = np.r_[0, np.cumsum(np.hypot(np.diff(np.log(fx)), np.diff(np.log(fy))))]
+    n = max(2, int(np.ceil(arc[-1]/spacing)) + 1)
+    t = np.exp(np.interp(np.linspace(0, arc[-1], n), arc, np.log(tf)))
+    if tmin < t0:
+        t = np.r_[tmin, t]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cx, cy = ct.tw(t) if tw else ct.wetherill(t)
+    return t, cx, cy
+
+
+def concordant(x, sx, y, sy, r, tw=False, conf=0.95, ct=None):
+    ''' Mask of the points whose conf error ellipse touches the concordia '''
+    d2, _ = concordiaDistance(x, sx, y, sy, r, tw, ct=ct)
+    return d2 <= scale(conf)**2
+
+
+def percentDiscordance(t75, t68, t76, method=0, t75e=None, t68e=None, sd=1):
+    ''' Percent discordance, 100 (1 - A/B)
+
+    Parameters:
+        t75, t68, t76: arrays of 207Pb/235U, 206Pb/238U and 207Pb/206Pb ages
+        method: 0: A = t68, B = t76
+                1: A = t75, B = t76
+                2: A = t68, B = t75
+                3: A = t75, B = t68
+                4: A = t75 - sd t75e, B = t68 + sd t68e
+        t75e, t68e: age uncertainties (only for method 4)
+        sd: multiple of the uncertainties (only for method 4)
+
+    Returns:
+        array of percent discordance
+    '''
+    t75, t68, t76 = (np.asarray(v, dtype=float) if v is not None else None for v in (t75, t68, t76))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if method == 0:
+            return (1 - t68/t76)*100
+        elif method == 1:
+            return (1 - t75/t76)*100
+        elif method == 2:
+            return (1 - t68/t75)*100
+        elif method == 3:
+            return (1 - t75/t68)*100
+        elif method == 4:
+            return (1 - (t75 - np.asarray(t75e)*sd)/(t68 + np.asarray(t68e)*sd))*100
+
+    raise ValueError('Unknown discordance method: %s'%method)
+
+
+def discordant(percent, threshold):
+    ''' Mask of the points with |percent discordance| >= threshold '''
+    return np.abs(np.asarray(percent)) >= threshold
+
+
+def concordantMask(df, conf=0.95, ct=None):
+    ''' Mask of the rows of a U-Pb DataFrame that are concordant at conf in
+        every concordia space (Wetherill and/or TW) its columns allow '''
+    from app.datatypes import Columns
+    spaces = [
+        (False, (Columns.Pb207_U235, Columns.Pb207_U235_err, Columns.Pb206_U238, Columns.Pb206_U238_err, Columns.WetherillErrorCorrelation)),
+        (True, (Columns.U238_Pb206, Columns.U238_Pb206_err, Columns.Pb207_Pb206, Columns.Pb207_Pb206_err, Columns.TWErrorCorrelation))
+    ]
+    mask = np.ones(len(df), dtype=bool)
+    for tw, cols in spaces:
+        if set(cols).issubset(df.columns):
+            mask &= concordant(*(df[c].values for c in cols), tw=tw, conf=conf, ct=ct)
+    return mask
@@ -0,0 +1,106 @@
+'''
+Batched error ellipse geometry.
+
+ellipses() turns arrays of (x, sx, y, sy, rho) into an (N, K, 2) array of
+polygon vertices. The 2x2 covariance eigen-decompositions are done in closed
+form for all points at once, the chi-squared scale factor is computed once per
+confidence level and the unit circle is shared between calls, so drawing
+thousands of analyses costs a handful of array operations.
+'''
+
+from functools import lru_cache
+import numpy as np
+
+
+@lru_cache(maxsize=8)
+def unitCircle(n=100):
+    ''' cos and sin of n angles from 0 to 2 pi (inclusive, so polygons close) '''
+    t = np.linspace(0, 2*np.pi, n, endpoint=True)
+    c, s = np.cos(t), np.sin(t)
+    c.flags.writeable = False
+    s.flags.writeable = False
+    return c, s
+
+
+@lru_cache(maxsize=8)
+def scale(conf=0.95):
+    ''' Radius of the conf region of a bivariate normal in standard units.
+        For 2 degrees of freedom chi2.ppf(conf, 2) = -2 ln(1 - conf). '''
+    return np.sqrt(-2*np.log1p(-conf))
+
+
+def axes(sx, sy, r):
+    ''' Semi-axes (in 1 sigma units) and orientation of the covariance ellipses
+
+    Parameters:
+        sx, sy, r: arrays of the x and y uncertainties (1 sigma) and their correlation
+
+    Returns:
+        (a, b, theta) with a >= b the semi-major and semi-minor axes and theta
+        the angle of the major axis from the x axis. Points with |r| > 1 are nan.
+    '''
+    sx, sy, r = (np.asarray(v, dtype=float) for v in (sx, sy, r))
+    vx, vy, cxy = sx**2, sy**2, r*sx*sy
+    h = (vx + vy)/2
+    d = np.hypot((vx - vy)/2, cxy)
+    bad = np.abs(r) > 1
+    a = np.where(bad, np.nan, np.sqrt(h + d))
+    b = np.where(bad, np.nan, np.sqrt(np.maximum(h - d, 0)))
+    theta = 0.5*np.arctan2(2*cxy, vx - vy)
+    return a, b, theta
+
+
+def ellipses(x, sx, y, sy, r, conf=0.95, n=100):
+    ''' Confidence ellipses for N points
+
+    Parameters:
+        x, sx, y, sy, r: arrays (or scalars) of values, 1 sigma uncertainties and correlations
+        conf: confidence level of the ellipses
+        n: number of vertices per ellipse
+
+    Returns:
+        (N, n, 2) array of closed polygons, all nan for invalid covariances
+    '''
+    x, sx, y, sy, r = np.broadcast_arrays(*(np.atleast_1d(np.asarray(v, dtype=float)) for v in (x, sx, y, sy, r)))
+    a, b, theta = axes(sx, sy, r)
+    k = scale(conf)
+    a, b = k*a, k*b
+    ct, st = unitCircle(n)
+    cth, sth = np.cos(theta)[:, None], np.sin(theta)[:, None]
+    u = a[:, None]*ct
+    v = b[:, None]*st
+    out = np.empty((len(x), n, 2))
+    out[..., 0] = x[:, None] + u*cth - v*sth
+    out[..., 1] = y[:, None] + u*sth + v*cth
+    return out
+
+
+def levelOfDetail(x, sx, y, sy, xlim, ylim, size, conf=0.95, minPixels=2, pixelsPerVertex=4, vertices=(12, 25, 50, 100)):
+    ''' How to draw each ellipse in a view
+
+    An ellipse is hidden if its bounding box (x +- k sx, y +- k sy) misses the
+    view, drawn as a point if it spans fewer than minPixels, and otherwise gets
+    about one vertex per pixelsPerVertex pixels of perimeter, rounded up to one
+    of the vertices levels so that geometry is shared between redraws.
+
+    Parameters:
+        x, sx, y, sy: arrays of values and 1 sigma uncertainties
+        xlim, ylim: (lower, upper) visible ranges of the axes
+        size: (width, height) of the axis rect in pixels
+
+    Returns:
+        array of vertex counts, 0 for hidden ellipses and 1 for points
+    '''
+    x, sx, y, sy = (np.atleast_1d(np.asarray(v, dtype=float)) for v in (x, sx, y, sy))
+    k = scale(conf)
+    px = size[0]/abs(xlim[1] - xlim[0])
+    py = size[1]/abs(ylim[1] - ylim[0])
+    visible = (x + k*sx >= min(xlim)) & (x - k*sx <= max(xlim)) & (y + k*sy >= min(ylim)) & (y - k*sy <= max(ylim))
+
+    # Semi-extents in pixels, the perimeter is taken as that of the bounding box's inscribed ellipse
+    w, h = k*sx*px, k*sy*py
+    perimeter = np.pi*(w + h)
+    levels = np.asarray(vertices)
+    n = levels[np.minimum(np.searchsorted(levels, perimeter/pixelsPerVertex), len(levels) - 1)]
+    n = np.where(2*np.maximum(w, h) < minPixels, 1, n)
+    return np.where(visible & np.isfinite(x + y + w + h), n, 0)
@@ -5,34 +5,64 @@ from QCustomPlot_PySide import QCustomPlot, QCPItemRect, QCPItemPosition, QCPIte
 from app.data import datasets
 from app.datatypes import Columns
 from app.preferences import l40K
-from uncertainties import ufloat, unumpy, correlated_values
-from uncertainties.unumpy import log, nominal_values, std_devs
+from uncertainties import ufloat
 import numpy as np
-from PySide2.QtCore import Qt
+from PySide2.QtCore import Qt, QObject, QRunnable, QThreadPool, Signal
+from PySide2.QtWidgets import QFileDialog, QMessageBox
 from PySide2.QtGui import QBrush, QColor, QPen
 from numpy import sqrt
-from app.math import fitLine, weightedMean
-# def meas_cov(x, u, v):
-#     try:
-#         return u.n * v.n * ((x.s / x.n) ** 2 - (u.s / u.n) ** 2 - (v.s / v.n) ** 2) / 2
-#     except (ZeroDivisionError,):
-#         return np.nan
-
-# get.cov.div <- function(A,err.A,B,err.B,AB,err.AB){
-#     0.5*A*B*((err.A/A)^2+(err.B/B)^2-(err.AB/AB)^2)
-# }
-
-def meas_cov(a, b, ab):
-    try:
-        return 0.5*a.n*b.n*( (a.s/a.n)**2 + (b.s/b.n)**2 - (ab.s/ab.n)**2)
-    except:
-        return np.nan
-
-def meas_cor(a, b, ab):
-    try:
-        return meas_cov(a, b, ab)/(a.s*b.s)
-    except:
-        return np.nan
+from app.math import fitLine
+from app.cache import results
+from app.arar import plateauTable, selectPlateau, plateauSweep, plateau, ages, stepColumns
+
+
+class SearchCancelled(Exception):
+    pass
+
+
+class PlateauSignals(QObject):
+    progress = Signal(int, str)
+    finished = Signal(object)
+
+
+class PlateauTask(QRunnable):
+    '''
+    Computes the plateau statistics table of a dataset on the global thread
+    pool.
+
+    A cancelled task stops at the next progress report of the search and
+    never emits finished.
+    '''
+
+    def __init__(self, request, key, dsname, df, J, l):
+        super().__init__()
+        self.request = request
+        self.key = key
+        self.dsname = dsname
+        self.args = (df, J, l)
+        self.result = None
+        self.cancelled = False
+        self.signals = PlateauSignals()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        def progress(p, msg):
+            if self.cancelled:
+                raise SearchCancelled()
+            self.signals.progress.emit(int(p), msg)
+
+        try:
+            self.result = plateauTable(*self.args, progress=progress)
+        except SearchCancelled:
+            return
+        except Exception as e:
+            print('There was a problem searching for a plateau: %s'%e)
+            self.result = None
+
+        self.signals.finished.emit(self)
+
 
 class ArAr(ARViewWidget):
 
@@ -51,6 +81,8 @@ class ArAr(ARViewWidget):
         self.l = ufloat(0.00055305, 0.00000132)
         self.initial40_36 = ufloat(298.56, 0.31)
         self.doPlateau = True
+        self.plateauRequest = 0
+        self.plateauTask = None
         self.propertyChanged.connect(self.updatePlot)
 
     def addDataset(self, dsname):
@@ -60,56 +92,34 @@ class ArAr(ARViewWidget):
     def createControlWidget(self):
         return ArArControlWidget(self)
 
-    def age(self, m, i40_36):
-        Ar39_40n = m[Columns.Ar39_Ar40]
-        Ar39_40s = m[Columns.Ar39_Ar40_err]
-        Ar36_40n = m[Columns.Ar36_Ar40]
-        Ar36_40s = m[Columns.Ar36_Ar40_err]
-        Ar39_36n = m[Columns.Ar39_Ar36]
-        Ar39_36s = m[Columns.Ar39_Ar36_err]
-
-        _39_40 = ufloat(Ar39_40n, Ar39_40s)
-        _36_40 = ufloat(Ar36_40n, Ar36_40s)
-        _39_36 = ufloat(Ar39_36n, Ar39_36s)
-
-        corr = np.array([
-            [Ar39_40s**2, meas_cov(_39_40, _36_40, _39_36)],
-            [meas_cov(_39_40, _36_40, _39_36), Ar36_40s**2]
-        ])
-
-        Ar39_40, Ar36_40 = correlated_values([Ar39_40n, Ar36_40n], corr, tags=['Ar39_40', 'Ar36_40'])
-        Rfact = ( (1./Ar36_40) - i40_36)*Ar36_40
-        Ar40rad_Ar39 = Rfact/Ar39_40       
-        t = (1/self.l)*log(self.J * Ar40rad_Ar39 + 1)
-        return t
-
-
     def updatePlot(self):
-        self.plot.clearItems()
-        self.plot.xAxis.grid().setVisible(False)
-        self.plot.yAxis.grid().setVisible(False)
-
         doPlat = 'plateau' in self.property('initialMode')
 
         if doPlat:
-            platRange, platAr, plat = self.findPlateau()
+            # The range statistics do not depend on the criteria, so they are
+            # computed once in the background and changing a criterion only
+            # reselects from them
+            table = self.plateauTable()
+            if table is None:
+                return
+            best = selectPlateau(table, *self.criteria())
+            doPlat = best is not None
+
+        if doPlat:
+            platRange = (int(table['first'].iloc[best]), int(table['last'].iloc[best]))
+            plat = results.call(
+                plateau, datasets[self.dsname], (self.J.n, self.J.s), (self.l.n, self.l.s), *platRange,
+                tag=self.dsname
+            )
+            print('Plateau range: %i to %i'%platRange)
             i40_36 = plat['i40_36']
         elif 'all' in self.property('initialMode'):
-            rho = np.array([
-                meas_cor(
-                    ufloat(m[Columns.Ar39_Ar40], m[Columns.Ar39_Ar40_err]),
-                    ufloat(m[Columns.Ar36_Ar40], m[Columns.Ar36_Ar40_err]),
-                    ufloat(m[Columns.Ar39_Ar36], m[Columns.Ar39_Ar36_err])
-                    )
-                for _, m in datasets[self.dsname].iterrows()
-            ])
-            res = fitLine(
-                datasets[self.dsname][Columns.Ar39_Ar40], 
-                datasets[self.dsname][Columns.Ar39_Ar40_err], 
-                datasets[self.dsname][Columns.Ar36_Ar40], 
-                datasets[self.dsname][Columns.Ar36_Ar40_err],
-                rho, 
-                model=1
+            a, sa, c, sc, cov = stepColumns(datasets[self.dsname])
+            res = results.call(
+                fitLine,
+                a, sa, c, sc, cov/(sa*sc),
+                model=1,
+                tag=self.dsname
             )
             intercept = ufloat(res['b'], res['sigma_b'])
             i40_36 = 1/intercept
@@ -118,9 +128,13 @@ class ArAr(ARViewWidget):
         
         print('Updating plot with initial 40/36 = %s'%i40_36)
 
+        self.plot.clearItems()
+        self.plot.xAxis.grid().setVisible(False)
+        self.plot.yAxis.grid().setVisible(False)
+
         ArAmount = datasets[self.dsname][Columns.ArAmount]
 
-        t = np.array([self.age(r[1], i40_36) for r in datasets[self.dsname].iterrows()])
+        t, st = ages(datasets[self.dsname], self.J, self.l, i40_36)
         f = 100*np.cumsum(ArAmount)/np.sum(ArAmount)
 
         fstart = 0
@@ -129,9 +143,9 @@ class ArAr(ARViewWidget):
             item = QCPItemRect(self.plot)
             self.plot.incref(item)
             item.position('topLeft').setType(QCPItemPosition.ptPlotCoords)
-            item.position('topLeft').setCoords(fstart, t[i].n - t[i].s)
+            item.position('topLeft').setCoords(fstart, t[i] - st[i])
             item.position('bottomRight').setType(QCPItemPosition.ptPlotCoords)
-            item.position('bottomRight').setCoords(fend, t[i].n + t[i].s)
+            item.position('bottomRight').setCoords(fend, t[i] + st[i])
             item.setBrush(QBrush(QColor(255, 255, 255, 100)))
             if doPlat and i in range(platRange[0], platRange[1]):
                 item.setBrush(QBrush(QColor(255, 0, 0, 100)))
@@ -161,123 +175,66 @@ class ArAr(ARViewWidget):
         self.plot.xAxis.setLabel('Cumulative ³⁹Ar Released (%)')
         self.plot.yAxis.setLabel('Apparent Age (Ma)')
         self.plot.xAxis.setRange(0,100)
-        self.plot.yAxis.setRange(t.min().n-2*t.min().s, t.max().n+2*t.max().s)
+        self.plot.yAxis.setRange(t.min()-2*st[t.argmin()], t.max()+2*st[t.argmax()])
         self.plot.replot()
 
 
-    def findPlateau(self):
-        ArAmount = datasets[self.dsname][Columns.ArAmount]
-   
-        Nsteps = len(ArAmount)
-        ArMinSteps = self.property('minArSteps')
-        minArPct = self.property('minArPct')
-        minIsoProb = self.property('minIsoProb')
-        minWMProb = self.property('minWMProb')
-
-        ranges = [(f, l) for f in range(Nsteps - ArMinSteps + 1) for l in range(f + ArMinSteps, Nsteps + 1)]
-        plateaus = {
-            r: {
-                'cf': (100*np.cumsum(ArAmount)/np.sum(ArAmount))[r[0]:r[1]],
-                'sf': 100*np.sum(ArAmount[r[0]:r[1]])/np.sum(ArAmount)
-            }
-            for r in ranges
-        }
-        self.beginProgress.emit()
-        for ri, r in enumerate(ranges):
-            # If this range does not contain enough Ar, skip it
-            self.progress.emit(100*ri/len(ranges), f'Checking range {ri+1}/{len(ranges)}')
-            if plateaus[r]['sf'] < minArPct:
-                print('Skipping range %i to %i due to low Ar %f'%(r[0], r[1], plateaus[r]['sf']))
-                continue
-
-            df = datasets[self.dsname][r[0]:r[1]]
-            rho = np.array([
-                meas_cor(
-                    ufloat(m[Columns.Ar39_Ar40], m[Columns.Ar39_Ar40_err]),
-                    ufloat(m[Columns.Ar36_Ar40], m[Columns.Ar36_Ar40_err]),
-                    ufloat(m[Columns.Ar39_Ar36], m[Columns.Ar39_Ar36_err])
-                    )
-                for _, m in df.iterrows()
-            ])
-
-            # Fit a line for each subset isochron to get probability of fit and initial 40/36 from inverse of intercept
-            try:
-                res = fitLine(
-                    df[Columns.Ar39_Ar40], 
-                    df[Columns.Ar39_Ar40_err], 
-                    df[Columns.Ar36_Ar40], 
-                    df[Columns.Ar36_Ar40_err],
-                    rho, 
-                    model=1
-                )
-            except Exception as e:
-                # If there was a problem with the fit, skip this range
-                print('There was a problem fitting an isochron for range %i to %i: %s'%(r[0], r[1], e))
-                continue
-
-            # If probability of fit too low, skip this range
-            if res['prob'] < minIsoProb:
-                print('Skipping range %i to %i due to low probability isochron %f'%(r[0], r[1], res['prob']))
-                continue
-
-            slope = ufloat(res['m'], res['sigma_m'])
-            inter = ufloat(res['b'], res['sigma_b'])
-            initial40_36 = 1/inter
-            plateaus[r]['ages'] = np.array([self.age(m, initial40_36) for _, m in df.iterrows()])
-            plateaus[r]['i40_36'] = initial40_36
-
-            # Check slope of line for ages vs mid frac:
-            print(plateaus[r]['cf'])
-            print(np.diff(np.insert(plateaus[r]['cf'].values, 0, 0))/2)
-            mf = plateaus[r]['cf'] - np.diff(np.insert(plateaus[r]['cf'].values, 0, 0))/2
-            try:
-                res = fitLine(
-                    mf, 
-                    np.zeros(len(mf)), 
-                    np.array([a.n for a in plateaus[r]['ages']]), 
-                    np.array([a.s for a in plateaus[r]['ages']]),
-                    np.zeros(len(mf)), 
-                    model=1
-                )
-            except:
-                continue
-
-            if abs(res['m']) >  abs(res['sigma_m']):
-                continue
-
-            # If we made it this far, get the range's weighted mean:
-            wm = weightedMean(nominal_values(plateaus[r]['ages']), std_devs(plateaus[r]['ages']))
-            if wm['prob'] < minWMProb:
-                print('Skipping range %i to %i due to low probability weighted mean %f'%(r[0], r[1], wm['prob']))
-                continue
-
-            plateaus[r]['wmage'] = wm
-
-            print('\n\nRANGE %i to %i'%(r[0], r[1]))
-            print(plateaus[r])
-
-        maxF = 0
-        pRange = None
-        for r in ranges:
-            if 'wmage' not in plateaus[r]:
-                continue
-
-            if plateaus[r]['sf'] > maxF:
-                maxF = plateaus[r]['sf']
-                pRange = r
-
-        print('Plateau range: %i to %i'%(pRange[0], pRange[1]))
-        print(plateaus[pRange]['wmage'])
+    def criteria(self):
+        return [self.property(p) for p in ('minArSteps', 'minArPct', 'minIsoProb', 'minWMProb')]
+
+    def plateauTable(self):
+        ''' The cached plateau statistics of the current dataset, or None
+            while they are being computed '''
+        key = results.key(plateauTable, datasets[self.dsname], self.J, self.l)
+        found, table = results.lookup(key)
+        if not found:
+            self.searchPlateau(key)
+        return table
+
+    def plateauSweep(self, **kwargs):
+        table = self.plateauTable()
+        if table is None:
+            return None
+        return plateauSweep(table, **kwargs)
+
+    def searchPlateau(self, key):
+        # Changing the criteria does not change the key, so a search for the
+        # same table is left to finish rather than restarted
+        if self.plateauTask is not None and self.plateauTask.key == key:
+            return
+
+        if self.plateauTask is not None:
+            self.plateauTask.cancel()
+        else:
+            self.beginProgress.emit()
+
+        self.plateauRequest += 1
+        task = PlateauTask(
+            self.plateauRequest, key, self.dsname, datasets[self.dsname].copy(),
+            (self.J.n, self.J.s), (self.l.n, self.l.s)
+        )
+        task.signals.progress.connect(self.progress)
+        task.signals.finished.connect(self.plateauFound)
+        self.plateauTask = task
+        QThreadPool.globalInstance().start(task)
+
+    def plateauFound(self, task):
+        if task.result is not None:
+            results.store(task.key, task.result, tag=task.dsname)
+        if task.request != self.plateauRequest:
+            return
+
+        self.plateauTask = None
         self.endProgress.emit()
-
-        return (pRange, maxF, plateaus[pRange])
+        if task.result is not None:
+            self.updatePlot()
 
 
 class ArArControlWidget(PlotControlWidget):
 
     def __init__(self, view, parent=None):
         super().__init__(view, parent)
-        from PySide2.QtWidgets import QLineEdit, QHBoxLayout, QLabel, QComboBox, QSpinBox, QGroupBox, QFormLayout, QDoubleSpinBox
+        from PySide2.QtWidgets import QLineEdit, QHBoxLayout, QLabel, QComboBox, QSpinBox, QGroupBox, QFormLayout, QDoubleSpinBox, QPushButton
         
         # J config
         self.jLineEdit = QLineEdit(self)
@@ -369,4 +326,24 @@ class ArArControlWidget(PlotControlWidget):
             self.specErrLineEdit.setVisible(s == 'Specified')
             plateauGroupBox.setVisible('plateau' in s)
 
-        self.iModeComboBox.activated[str].connect(lambda s: updateModeControls(s))
\ No newline at end of file
+        self.sweepButton = QPushButton('Export criteria sweep', self)
+        plateauGroupBox.layout().addRow(self.sweepButton)
+        self.sweepButton.clicked.connect(self.exportSweep)
+
+        self.iModeComboBox.activated[str].connect(lambda s: updateModeControls(s))
+
+    def exportSweep(self):
+        ''' Saves the plateau selected by every combination of criteria '''
+        sweep = self.view.plateauSweep(minSteps=np.arange(self.view.property('minArSteps'), 11))
+        if sweep is None:
+            QMessageBox.information(self, 'Criteria sweep', 'The plateau statistics are still being computed.')
+            return
+
+        fn, ok = QFileDialog.getSaveFileName(self, 'Export criteria sweep')
+        if not ok:
+            return
+
+        if fn.endswith('xlsx'):
+            sweep.to_excel(fn, index=False)
+        else:
+            sweep.to_csv(fn, index=False)
\ No newline at end of file
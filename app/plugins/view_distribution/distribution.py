@@ -13,6 +13,8 @@ from app.widgets.ViewWidget import ARViewWidget
 from app.preferences import applyStyleToPlot
 from app.data import datasets
 from app.datatypes import ColumnTypes
+from app.discordance import concordantMask
+from app.cache import results
 
 import numpy as np
 import os
@@ -44,6 +46,7 @@ class Distribution(ARViewWidget):
         self.setProperty('ticks', True)
         self.setProperty('tickLength', 8)
         self.setProperty('tickPen', QPen(Qt.black))
+        self.setProperty('concordantOnly', False)
 
         self.propertyChanged.connect(self.updateView)
 
@@ -65,6 +68,10 @@ class Distribution(ARViewWidget):
         except:
             return
 
+        if self.property('concordantOnly'):
+            mask = results.call(concordantMask, df, tag=self.dsname)
+            d, ed = d[mask], ed[mask]
+
         self.plot.clearGraphs()
         self.plot.clearPlottables()
 
@@ -143,6 +150,10 @@ class DistributionProperties(PlotControlWidget):
         self.layout().insertRow(1, 'Data', self.dataComboBox)
         self.layout().insertRow(2, 'Error', self.errComboBox)
 
+        self.concordantCheckBox = QCheckBox('Only concordant analyses (95% ellipse)', self)
+        self.concordantCheckBox.toggled.connect(lambda b: view.setProperty('concordantOnly', b))
+        self.layout().insertRow(3, self.concordantCheckBox)
+
         loader = QUiLoader()
         loader.registerCustomWidget(PenButton)
         options = loader.load(os.path.dirname(__file__) + '/distribution_control.ui', self)
@@ -7,6 +7,7 @@ from app.widgets.ViewWidget import ARViewWidget
 from app.widgets.ControlWidget import PlotControlWidget
 from app.thirdparty.UPbplot import SlopeIntercept
 from app.math import fitLine
+from app.cache import results
 import numpy as np
 from uncertainties import ufloat
 from uncertainties.umath import *
@@ -87,7 +88,7 @@ class Isochron(ARViewWidget):
         #Xb, Yb, ai, bi, sai, sbi = SlopeIntercept(x, y, xerr, yerr, r, 1)
         #print('Xb = %f, Yb = %f, ai = %f, bi = %f, sai = %f, sbi = %f'%(Xb, Yb, ai, bi, sai, sbi))
 
-        fit = fitLine(x, xerr, y, yerr, r, self.property('FitModel'))
+        fit = results.call(fitLine, x, xerr, y, yerr, r, self.property('FitModel'), tag=self.dsname)
         bi = fit['m']
         sbi = fit['sigma_m']
         ai = fit['b']
@@ -9,16 +9,18 @@ from app.widgets.ControlWidget import PlotControlWidget
 from app.widgets.QCPItemRichText import QCPItemRichText
 
 from QCustomPlot_PySide import *
-from PySide2.QtCore import Qt, QSettings
+from PySide2.QtCore import Qt, QSettings, QTimer
 from PySide2.QtWidgets import QCheckBox, QWidget, QLineEdit, QLabel, QFormLayout, QSpinBox, QToolButton, QGroupBox, QComboBox, QFileDialog, QSlider
 from PySide2.QtGui import QColor, QPen, QBrush
 
 from math import pi, atan
 
-from app.math import discordiaAge, concordiaAge, formatResult
+from app.math import discordiaAge, concordiaAge, formatResult, WeightedMean2DStats
+from app.concordia import table as concordiaTable
+from app.cache import results
 from app.thirdparty.spine import calcage
-from app.thirdparty.UPbplot import myEllipse, calc_intercept_age
-from shapely.geometry import LineString
+from app.ellipse import ellipses, levelOfDetail
+from app.thirdparty.UPbplot import calc_intercept_age
 
 
 import pickle
@@ -43,16 +45,30 @@ class UPbConcordia(ARViewWidget):
             'color': QColor(Qt.blue),
             'alpha': 120,
             'column': None,
-            'gradient': 'Hot'
+            'gradient': 'Hot',
+            'lod': True
         }
 
         self.plot = self.widget()
         self.plot.axisRect().setupFullAxesBox(True)
         preferences.applyStyleToPlot(self.plot)
+        self.plot.addLayer('results')
         self.ellipses = []
+        self.dataCurves = []
+        self.pointCurves = []
+        self.ellipseData = None
+        self.cullPlan = None
+        self.cullPending = False
         self.tw = True
+        self.wmStats = None
+        self.wmStatsKey = None
         self.setupConcordia()
 
+        self.plot.xAxis.rangeChanged.connect(self.scheduleCull)
+        self.plot.yAxis.rangeChanged.connect(self.scheduleCull)
+        # Catches resizes, the cull only replots if the plan changed
+        self.plot.afterReplot.connect(self.scheduleCull)
+
 
     def createControlWidget(self):
         return UPbConcordiaControlWidget(self)
@@ -67,24 +83,27 @@ class UPbConcordia(ARViewWidget):
         self.plot.clearPlottables()
         self.plot.clearItems()
         self.ellipses = []
+        self.dataCurves = []
+        self.pointCurves = []
+        self.ellipseData = None
+        self.cullPlan = None
 
-        time_ma = np.arange(0, 4600, 1)
         time_markers_ma = np.arange(self.markers['min'], self.markers['max'], self.markers['sep'])
+        ct = concordiaTable()
 
         # Plot concordia curve:
         if self.tw:
-            fx = lambda t: 1 / (np.exp(l238U * t * 1e6) - 1)
-            fy = lambda t: (1 / U85r) * (np.exp(l235U * t * 1e6) - 1) / (np.exp(l238U * t * 1e6) - 1)
+            fx = lambda t: ct.tw(t * 1e6)[0]
+            fy = lambda t: ct.tw(t * 1e6)[1]
             self.plot.yAxis.setLabel(Columns.Pb207_Pb206)
             self.plot.xAxis.setLabel(Columns.U238_Pb206)        
         else:
-            fx = lambda t: np.exp(l235U * t * 1e6) - 1
-            fy = lambda t: np.exp(l238U * t * 1e6) - 1
+            fx = lambda t: ct.wetherill(t * 1e6)[0]
+            fy = lambda t: ct.wetherill(t * 1e6)[1]
             self.plot.yAxis.setLabel(Columns.Pb206_U238)
             self.plot.xAxis.setLabel(Columns.Pb207_U235)
 
-        conc_x = fx(time_ma)
-        conc_y = fy(time_ma)
+        _, conc_x, conc_y = ct.curve(self.tw, 0, 4600e6)
 
         # Plot concordia markers
         conc_x_markers = fx(time_markers_ma)
@@ -116,35 +135,115 @@ class UPbConcordia(ARViewWidget):
 
         self.plot.replot()
 
-    def eigsorted(self, cov):
-        vals, vecs = np.linalg.eigh(cov)
-        order = vals.argsort()[::-1]
-        return vals[order], vecs[:, order]
-
-
-    def ellipse(self, x, xs, y, ys, p, color=QColor(Qt.blue), nstd=2, **kwargs):
-        # cov = np.array([[xs ** 2, p * xs * ys], [p * xs * ys, ys ** 2]])
-        # vals, vecs = self.eigsorted(cov)
-        # theta = np.degrees(np.arctan2(*vecs[:, 0][::-1]))*pi/180.0
-        # w, h = 2 * nstd * np.sqrt(vals)
-        # v = np.linspace(0.0, 2.0*pi)
-        # xell = x + w*np.cos(theta)*np.cos(v) - h*np.sin(theta)*np.sin(v)
-        # yell = y + h*np.sin(theta)*np.cos(v) + h*np.cos(theta)*np.sin(v)
-        xell, yell = myEllipse(0, x, y, xs, ys, p*xs*ys, conf=0.95)
-        ell = QCPCurve(self.plot.xAxis, self.plot.yAxis)        
-        ell.setData(xell, yell)
+    def ellipse(self, x, xs, y, ys, p, color=QColor(Qt.blue), **kwargs):
+        return self.curve(ellipses(x, xs, y, ys, p, conf=0.95)[0], color)
+
+    def curve(self, xy, color=QColor(Qt.blue), ell=None):
+        if ell is None:
+            ell = QCPCurve(self.plot.xAxis, self.plot.yAxis)
+            self.plot.incref(ell)
+        ell.setData(xy[:, 0], xy[:, 1])
         ell.setPen(color)
+        color = QColor(color)
         color.setAlpha(self.estyle['alpha'])
         ell.setBrush(color)
-        self.plot.incref(ell)
         return ell
 
+    def ellipseColors(self, values):
+        ''' Gradient colors of values for the Variable ellipse mode '''
+        g = QCPColorGradient(QCPColorGradient.GradientPreset.__dict__['gp' + self.estyle['gradient']])
+        r = QCPRange(*self.ellipseData['range'])
+        return [QColor(g.color(v, r)) for v in values]
+
+    def scheduleCull(self, *args):
+        if self.cullPending or self.ellipseData is None:
+            return
+
+        # Both axes emit while panning, so cull once after the events are processed
+        self.cullPending = True
+        QTimer.singleShot(0, lambda: self.cullEllipses(replot=True))
+
+    def cullEllipses(self, replot=False):
+        ''' Draws the data ellipses in the visible range
+
+        With level of detail on, ellipses outside the axis ranges are skipped,
+        those smaller than a couple of pixels are collapsed to points (batched
+        into one curve per color) and the rest get a vertex count that suits
+        their size on screen. Curves are reused between calls.
+        '''
+        self.cullPending = False
+        e = self.ellipseData
+        if e is None:
+            return
+
+        if self.estyle.get('lod', True):
+            xr, yr = self.plot.xAxis.range(), self.plot.yAxis.range()
+            rect = self.plot.axisRect()
+            n = levelOfDetail(
+                e['x'], e['sx'], e['y'], e['sy'],
+                (xr.lower, xr.upper), (yr.lower, yr.upper),
+                (max(rect.width(), 1), max(rect.height(), 1)),
+                conf=0.95
+            )
+        else:
+            n = np.full(len(e['x']), 100)
+
+        if self.cullPlan is not None and np.array_equal(n, self.cullPlan):
+            return
+
+        self.cullPlan = n
+
+        # Ellipses, grouped by vertex count so each group is one ellipses() call
+        drawn = np.flatnonzero(n > 1)
+        while len(self.dataCurves) < len(drawn):
+            self.dataCurves.append(self.curve(np.empty((0, 2))))
+
+        curves = iter(self.dataCurves)
+        for k in np.unique(n[drawn]):
+            sel = drawn[n[drawn] == k]
+            xy = ellipses(e['x'][sel], e['sx'][sel], e['y'][sel], e['sy'][sel], e['r'][sel], conf=0.95, n=k)
+            colors = self.ellipseColors(e['c'][sel]) if e['c'] is not None else [self.estyle['color']]*len(sel)
+            for i, exy, c in zip(sel, xy, colors):
+                ell = self.curve(exy, c, next(curves))
+                ell.setProperty('dataIndex', e['index'][i])
+                ell.setVisible(True)
+
+        for ell in curves:
+            ell.setVisible(False)
+
+        # Points, one scatter curve per color (Variable mode colors are binned)
+        [self.plot.removePlottable(pc) for pc in self.pointCurves]
+        self.pointCurves = []
+        points = np.flatnonzero(n == 1)
+        if len(points):
+            if e['c'] is None:
+                groups = [(points, self.estyle['color'])]
+            else:
+                lo, hi = e['range']
+                bins = np.clip(np.round(15*(e['c'][points] - lo)/((hi - lo) or 1)), 0, 15)
+                groups = [(points[bins == b], self.ellipseColors([lo + b*(hi - lo)/15])[0]) for b in np.unique(bins)]
+
+            for sel, c in groups:
+                pc = QCPCurve(self.plot.xAxis, self.plot.yAxis)
+                self.plot.incref(pc)
+                pc.setData(e['x'][sel], e['y'][sel])
+                pc.setLineStyle(QCPCurve.lsNone)
+                pc.setScatterStyle(QCPScatterStyle(QCPScatterStyle.ssDisc, c, 3))
+                pc.setProperty('dataIndices', [e['index'][i] for i in sel])
+                self.pointCurves.append(pc)
+
+        if replot:
+            self.plot.replot()
+
     def updateView(self):
         df = self.df
         # Plot data ellipses
 
-        [self.plot.removePlottable(ell) for ell in self.ellipses]
+        [self.plot.removePlottable(ell) for ell in self.ellipses + self.dataCurves + self.pointCurves]
         self.ellipses = []
+        self.dataCurves = []
+        self.pointCurves = []
+        self.cullPlan = None
 
         x_col = Columns.U238_Pb206 if self.tw else Columns.Pb207_U235
         x_err_col = Columns.U238_Pb206_err if self.tw else Columns.Pb207_U235_err
@@ -152,28 +251,24 @@ class UPbConcordia(ARViewWidget):
         y_err_col = Columns.Pb207_Pb206_err if self.tw else Columns.Pb206_U238_err
         rho_col = Columns.TWErrorCorrelation if self.tw else Columns.WetherillErrorCorrelation        
 
-        if self.estyle['mode'] == 'Fixed':
-            c = self.estyle['color']
-        else:
+        self.ellipseData = {
+            'x': df[x_col].values.astype(float),
+            'sx': df[x_err_col].values.astype(float),
+            'y': df[y_col].values.astype(float),
+            'sy': df[y_err_col].values.astype(float),
+            'r': df[rho_col].values.astype(float),
+            'index': list(df.index),
+            'c': None
+        }
+
+        if self.estyle['mode'] != 'Fixed':
             g = QCPColorGradient(QCPColorGradient.GradientPreset.__dict__['gp' + self.estyle['gradient']])
             el_col = self.estyle['column']
-            self.colorScale.setDataRange(QCPRange(df[el_col].min(), df[el_col].max()))
+            self.ellipseData['c'] = df[el_col].values.astype(float)
+            self.ellipseData['range'] = (df[el_col].min(), df[el_col].max())
+            self.colorScale.setDataRange(QCPRange(*self.ellipseData['range']))
             self.colorScale.setGradient(g)
 
-        for index, row in df.iterrows():
-            if self.estyle['mode'] == 'Variable':              
-                c = QColor(g.color(row[el_col], QCPRange(df[el_col].min(), df[el_col].max())))
-
-            self.ellipses.append(self.ellipse(
-                row[x_col],
-                row[x_err_col],
-                row[y_col],
-                row[y_err_col],
-                row[rho_col],
-                color=c
-                ))
-            self.ellipses[-1].setProperty('dataIndex', index)
-                
         try:
             self.plot.removeItem(self.line)
         except:
@@ -198,6 +293,7 @@ class UPbConcordia(ARViewWidget):
         self.plot.xAxis.scaleRange(1.2)        
         self.plot.yAxis.setRange(df[y_col].min(), df[y_col].max())
         self.plot.yAxis.scaleRange(1.2)
+        self.cullEllipses()
         self.plot.replot()
 
     def addDataset(self, name):
@@ -224,7 +320,7 @@ class UPbConcordia(ARViewWidget):
         #m = res['m']
         #a = calcage((b, m))
         #print(a)
-        da = discordiaAge(df[x_col], df[x_err_col], df[y_col], df[y_err_col], df[rho_col], self.tw, 500, 100, model)
+        da = results.call(discordiaAge, df[x_col], df[x_err_col], df[y_col], df[y_err_col], df[rho_col], self.tw, 500, 100, model, tag=self.dsname)
         m = da['fit']['m']
         b = da['fit']['b']
 
@@ -272,7 +368,14 @@ class UPbConcordia(ARViewWidget):
         y_err_col = Columns.Pb207_Pb206_err if self.tw else Columns.Pb206_U238_err
         rho_col = Columns.TWErrorCorrelation if self.tw else Columns.WetherillErrorCorrelation
 
-        ca = concordiaAge(df[x_col], df[x_err_col], df[y_col], df[y_err_col], df[rho_col], self.tw)
+        # Keyed on the values, so edits and derived columns recomputed with
+        # new constants rebuild the sums while pointDeleted only updates them
+        key = results.key(WeightedMean2DStats, df[x_col], df[x_err_col], df[y_col], df[y_err_col], df[rho_col])
+        if key != self.wmStatsKey:
+            self.wmStats = WeightedMean2DStats(df[x_col], df[x_err_col], df[y_col], df[y_err_col], df[rho_col], df.index)
+            self.wmStatsKey = key
+
+        ca = results.call(concordiaAge, df[x_col], df[x_err_col], df[y_col], df[y_err_col], df[rho_col], self.tw, wm=self.wmStats.result(), tag=self.dsname)
         print(ca)
 
         t = ca['t']
@@ -282,7 +385,46 @@ class UPbConcordia(ARViewWidget):
         n = ca['wm']['n']
         x, sx, y, sy, r = ca['wm']['x_bar'], ca['wm']['sigma_x_bar'], ca['wm']['y_bar'], ca['wm']['sigma_y_bar'], ca['wm']['rho_xy_bar']
         self.ellipses.append(self.ellipse(x, sx, y, sy, r, color=QColor(Qt.red)))
+        self.ellipses[-1].setLayer('results')
+
+
+    def pointDeleted(self, di):
+        e = self.ellipseData
+        if e is None:
+            return False
+
+        if self.wmStats is not None and di in self.wmStats:
+            self.wmStats.remove(di)
+            df = self.df
+            x_col = Columns.U238_Pb206 if self.tw else Columns.Pb207_U235
+            x_err_col = Columns.U238_Pb206_err if self.tw else Columns.Pb207_U235_err
+            y_col = Columns.Pb207_Pb206 if self.tw else Columns.Pb206_U238
+            y_err_col = Columns.Pb207_Pb206_err if self.tw else Columns.Pb206_U238_err
+            rho_col = Columns.TWErrorCorrelation if self.tw else Columns.WetherillErrorCorrelation
+            self.wmStatsKey = results.key(WeightedMean2DStats, df[x_col], df[x_err_col], df[y_col], df[y_err_col], df[rho_col])
+
+        # Drop the point from the drawn data and redo the fits, keeping the
+        # axis ranges and reusing the ellipse curves
+        keep = np.array([i != di for i in e['index']], dtype=bool)
+        for k in ('x', 'sx', 'y', 'sy', 'r'):
+            e[k] = e[k][keep]
+        e['index'] = [i for i, kept in zip(e['index'], keep) if kept]
+        if e['c'] is not None:
+            e['c'] = e['c'][keep]
+            e['range'] = (self.df[self.estyle['column']].min(), self.df[self.estyle['column']].max())
+            self.colorScale.setDataRange(QCPRange(*e['range']))
 
+        [self.plot.removePlottable(ell) for ell in self.ellipses]
+        self.ellipses = []
+        self.line.setVisible(False)
+        self.caption.setVisible(False)
+        self.updateFit()
+        self.updateConcAge()
+
+        self.cullPlan = None
+        self.cullEllipses(replot=True)
+        self.dataChanged.emit()
+        return True
 
     def saveState(self):
         s = {
@@ -428,6 +570,11 @@ class UPbConcordiaControlWidget(PlotControlWidget):
         self.ellipseAlphaSlider.valueChanged.connect(lambda v: setEllipseAndUpdate('alpha', v))
         ellGroupBox.layout().addRow('Opacity', self.ellipseAlphaSlider)
 
+        self.lodCheckBox = QCheckBox('Only draw visible ellipses at screen resolution', self)
+        self.lodCheckBox.setChecked(view.estyle.get('lod', True))
+        self.lodCheckBox.toggled.connect(lambda b: setEllipseAndUpdate('lod', b))
+        ellGroupBox.layout().addRow(self.lodCheckBox)
+
         self.gradComboBox = QComboBox(self)
         self.gradComboBox.addItems(['Grayscale', 'Hot', 'Cold', 'Night', 'Candy', 'Geography', 'Ion', 'Thermal', 'Polar', 'Spectrum', 'Jet', 'Hues'])
         self.gradComboBox.currentTextChanged.connect(lambda s: setEllipseAndUpdate('gradient', s))
@@ -4,15 +4,17 @@ from app.widgets.ColumnComboBox import ColumnComboBox
 from app.widgets.QCPItemRichText import QCPItemRichText
 from QCustomPlot_PySide import *
 
-from PySide2.QtWidgets import QComboBox
-from PySide2.QtGui import QPen
+from PySide2.QtWidgets import QComboBox, QCheckBox
+from PySide2.QtGui import QPen, QColor
 from PySide2.QtCore import Qt
 
 from app.data import datasets
 from app.preferences import applyStyleToPlot
-from app.math import formatResult, weightedMean, formatResult
+from app.math import formatResult, WeightedMeanStats, gesd
+from app.cache import results
 from app.datatypes import Columns
 
+import numpy as np
 import pickle
 
 class WeightedMean(ARViewWidget):
@@ -25,11 +27,19 @@ class WeightedMean(ARViewWidget):
 
         self.column = None
         self.dsname = None
+        self.stats = None
+        self.statsKey = None
+        self.rejectOutliers = False
+        self.rejected = None
 
     def setColumn(self, columnName):
         self.column = columnName
         self.updatePlot()
 
+    def setRejectOutliers(self, reject):
+        self.rejectOutliers = reject
+        self.updatePlot()
+
     def addDataset(self, datasetName):
         if not self.column:
             self.column = datasets[datasetName].columns[0]
@@ -37,10 +47,7 @@ class WeightedMean(ARViewWidget):
         self.dsname = datasetName
         self.updatePlot()
 
-    def updatePlot(self):
-        if not self.dsname or not self.column:
-            return
-
+    def data(self):
         y = datasets[self.dsname][self.column].values
 
         try:
@@ -49,7 +56,29 @@ class WeightedMean(ARViewWidget):
             print('Could not find error data for %s. Assuming 5 percent.'%(self.column))
             yerr = 0.05*y
 
-        res = weightedMean(y, yerr)
+        return y, yerr
+
+    def updatePlot(self):
+        if not self.dsname or not self.column:
+            return
+
+        y, yerr = self.data()
+
+        # Running sums are rebuilt only when the values change (e.g. edited
+        # data or derived columns recomputed with new constants), deleted
+        # points are taken out in pointDeleted. Outliers depend on all of the
+        # points, so they are found again on every update.
+        df = datasets[self.dsname]
+        key = results.key(WeightedMeanStats, y, yerr, df.index.values)
+        if self.rejectOutliers:
+            kept, self.rejected = gesd(y, yerr)
+            self.stats = WeightedMeanStats(y[kept], yerr[kept], df.index[kept])
+            self.statsKey = None
+        elif key != self.statsKey:
+            self.stats = WeightedMeanStats(y, yerr, df.index)
+            self.statsKey = key
+            self.rejected = None
+        res = self.stats.result(external=False)
         print(res)
         x = range(len(y))
 
@@ -68,6 +97,12 @@ class WeightedMean(ARViewWidget):
         self.eb.removeFromLegend()
         self.plot.incref(self.eb)
 
+        if self.rejected is not None and self.rejected.any():
+            self.rejectedGraph = self.plot.addGraph()
+            self.rejectedGraph.setData(np.flatnonzero(self.rejected), y[self.rejected])
+            self.rejectedGraph.setLineStyle(QCPGraph.lsNone)
+            self.rejectedGraph.setScatterStyle(QCPScatterStyle(QCPScatterStyle.ssCross, QColor(Qt.red), 12))
+
         self.line = QCPItemStraightLine(self.plot)
         self.line.position('point1').setType(QCPItemPosition.ptPlotCoords)
         self.line.position('point2').setType(QCPItemPosition.ptPlotCoords)
@@ -92,6 +127,18 @@ class WeightedMean(ARViewWidget):
         self.plot.xAxis.setTickLabels(False)
         self.plot.replot()
 
+    def pointDeleted(self, di):
+        if not self.dsname or not self.column:
+            return False
+
+        if not self.rejectOutliers and self.stats is not None and di in self.stats:
+            self.stats.remove(di)
+            y, yerr = self.data()
+            self.statsKey = results.key(WeightedMeanStats, y, yerr, datasets[self.dsname].index.values)
+
+        self.updatePlot()
+        return True
+
     def createControlWidget(self):
         return WMControlWidget(self)
 
@@ -99,6 +146,7 @@ class WeightedMean(ARViewWidget):
         s = {
             'column': self.column,
             'datasetName': self.dsname,
+            'rejectOutliers': self.rejectOutliers,
             'plotSettings': self.plot.saveState()
         }
         return pickle.dumps(s)
@@ -106,6 +154,7 @@ class WeightedMean(ARViewWidget):
     def restoreState(self, state):
         s = pickle.loads(state)
         print(s)
+        self.rejectOutliers = s.get('rejectOutliers', False)
         self.setColumn(s['column'])
         self.addDataset(s['datasetName'])
         self.plot.restoreState(s['plotSettings'])
@@ -118,3 +167,8 @@ class WMControlWidget(PlotControlWidget):
         self.columnComboBox = ColumnComboBox(self)
         self.columnComboBox.columnChanged.connect(widget.setColumn)        
         self.layout().insertRow(1, 'Column', self.columnComboBox)
+
+        self.outlierCheckBox = QCheckBox('Reject outliers (generalized ESD, 95%)', self)
+        self.outlierCheckBox.setChecked(widget.rejectOutliers)
+        self.outlierCheckBox.toggled.connect(widget.setRejectOutliers)
+        self.layout().insertRow(2, self.outlierCheckBox)
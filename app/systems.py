@@ -33,6 +33,17 @@ class UPb(System):
     Pb208_Th232_age = '²⁰⁸Pb/²³²Th age'
     Pb208_Th232_age_err = '²⁰⁸Pb/²³²Th age error'
 
+    Discordance = '²⁰⁶Pb/²³⁸U vs ²⁰⁷Pb/²⁰⁶Pb age discordance (%)'
+
+    # ²⁰⁷Pb-corrected (common Pb removed along a line to the Stacey-Kramers composition)
+    U238_Pb206_207corr = '²⁰⁷Pb-corrected ²³⁸U/²⁰⁶Pb'
+    Pb206_U238_207corr = '²⁰⁷Pb-corrected ²⁰⁶Pb/²³⁸U'
+    Pb207_Pb206_207corr = '²⁰⁷Pb-corrected ²⁰⁷Pb/²⁰⁶Pb'
+    Pb207_Pb206_common = 'Common ²⁰⁷Pb/²⁰⁶Pb'
+    f206 = 'Common ²⁰⁶Pb fraction f206 (%)'
+    Pb206_U238_207corr_age = '²⁰⁷Pb-corrected ²⁰⁶Pb/²³⁸U age'
+    Pb206_U238_207corr_age_err = '²⁰⁷Pb-corrected ²⁰⁶Pb/²³⁸U age error'
+
 class UTh(System):
     name = 'U-Th'
     Th232_U238 = '²³²Th/²³⁸U'
@@ -110,6 +110,11 @@ from matplotlib.patches import Ellipse
 
 # Intersections between concordia line and error ellipses
 from shapely.geometry import Polygon, LineString, LinearRing
+from app.concordia import table as concordia_table, diseq
+from app.discordance import minDistance
+from app.ellipse import scale as ellipse_scale
+from app.commonpb import correct207
+from app.math import gesd
 
 debug = 1
 
@@ -225,28 +230,10 @@ def ConcLineConv(t):
     if opt_correct_disequilibrium:
         # Sakata et al., 2017, Quaternary Geochronology, eqs. (8) and (9)
         # http://dx.doi.org/10.1016/j.quageo.2016.11.002
-        X = (
-            np.exp(l235U * t)
-            - 1
-            + l235U
-            / l231Pa
-            * (f_Pa_U - 1)
-            * (1 - np.exp(-l231Pa * t))
-            * np.exp(l235U * t)
-        )
-        Y = (
-            np.exp(l238U * t)
-            - 1
-            + l238U
-            / l230Th
-            * (f_Th_U - 1)
-            * (1 - np.exp(-l230Th * t))
-            * np.exp(l238U * t)
-        )
-    else:
-        X = np.exp(l235U * t) - 1
-        Y = np.exp(l238U * t) - 1
-    return (X, Y)
+        X = diseq(t, l235U, f_Pa_U, l231Pa)[0]
+        Y = diseq(t, l238U, f_Th_U, l230Th)[0]
+        return (X, Y)
+    return concordia_table(l238U, l235U, U85r).wetherill(t)
 
 
 # Plot a conventional concordia curve
@@ -284,21 +271,10 @@ def PlotConcConv(axcc, Xconv, Yconv, time, age_unit, legend_font_size):
 
 def ConcLineTW(t):
     if opt_correct_disequilibrium:
-        Xr = (np.exp(l238U * t) - 1) + l238U / l230Th * (f_Th_U - 1) * (
-            1 - np.exp(-l230Th * t)
-        ) * np.exp(l238U * t)
-        Yr = (np.exp(l235U * t) - 1) + l235U / l231Pa * (f_Pa_U - 1) * (
-            1 - np.exp(-l231Pa * t)
-        ) * np.exp(l235U * t)
-
-        X = 1.0 / Xr
-        Y = (Yr / Xr) / U85r
-    else:
-        Xr = np.exp(l238U * t) - 1
-        Yr = np.exp(l235U * t) - 1
-        X = 1.0 / Xr
-        Y = (Yr / Xr) / U85r
-    return (X, Y)
+        Xr = diseq(t, l238U, f_Th_U, l230Th)[0]
+        Yr = diseq(t, l235U, f_Pa_U, l231Pa)[0]
+        return (1.0 / Xr, (Yr / Xr) / U85r)
+    return concordia_table(l238U, l235U, U85r).tw(t)
 
 
 # Plot a Terra-Wasserburg concordia curve
@@ -799,56 +775,10 @@ def calc_chi2_red(x, s1, wm, n, opt):
 # Rosner, Bernard (May 1983), Percentage Points for a Generalized ESD
 #            Many-Outlier Procedure,Technometrics, 25(2), pp. 165-172.
 def GESDtest(Tall, s1, ind, cr):
-
-    conf = 1 - cr  # significant level is conf (e.g. 0.05)
-    ss = 2.0  # 2 sigma level
-    x0 = Tall[ind]
-    x = x0
-    s0 = s1[ind]
-    s = s0
-    ii = ind
-    oo = []
-    while True:
-        x = Tall[ii]
-        s = s1[ii]
-        n = len(x)
-        t = stats.t.ppf(q=(1 - cr / (2 * n)), df=n - 2)
-        tau = (n - 1) * t / np.sqrt(n * (n - 2) + n * t * t)
-        xs_min, xs_max = np.min(x + ss * s), np.max(x - ss * s)
-
-        i_max = [i for i in ind if x0[i] - ss * s0[i] == xs_max]
-        # if data have the multiple maximum values, the datum with large error will be excluded.
-        if len(i_max) > 1:
-            smax = s0.min()
-            for j in i_max:
-                if s0[j] > smax:
-                    smax = s0[j]
-            ii_max = [i for i in ind if s0[i] == smax]
-
-        i_min = [i for i in ind if x0[i] + ss * s0[i] == xs_min]
-        # if data have the multiple minimum values, the datum with larger error will be excluded.
-        if len(i_min) > 1:
-            smax = s0.min()
-            for j in i_min:
-                if s0[j] > smax:
-                    smax = s0[j]
-            i_min = [i for i in ind if s0[i] == smax]
-
-        Twm, sm, MSWD = oneWM(x[ii], s[ii], conf)
-        if np.abs(xs_max - Twm) > np.abs(xs_min - Twm) and xs_max >= Twm:
-            i_far = i_max[-1]
-            tau_far = np.abs(((x[i_far] - ss * s[i_far]) - Twm) / sm)
-        elif np.abs(xs_max - Twm) <= np.abs(xs_min - Twm) and xs_min <= Twm:
-            i_far = i_min[-1]
-            tau_far = np.abs(((x[i_far] + ss * s[i_far]) - Twm) / sm)
-        else:
-            break
-
-        if float(tau_far) < tau:
-            break
-
-        ii = np.delete(ii, np.where(ii == i_far))
-
+    # significant level is cr (e.g. 0.05), data compared at the 2 sigma level
+    ind = np.asarray(ind)
+    kept, rejected = gesd(np.asarray(Tall)[ind], np.asarray(s1)[ind], cr, 2.0)
+    ii = ind[kept]
     oo = np.setdiff1d(ind, ii)
     return (ii, oo)
 
@@ -948,13 +878,15 @@ def intersections_ellipse(x, y, line):
 # ------------------------------------------------
 # Judgement of discordance (disc_type == 5)
 def discordant_judge(xd, yd, sigma_xd, sigma_yd, cov_xdyd, conf, i_in, i_disc, line):
-    i_ind = i_in
-    for j, i in enumerate(i_in):
-        dp_ell_x, dp_ell_y = myEllipse(
-            i, xd[i], yd[i], sigma_xd[i], sigma_yd[i], cov_xdyd[i], conf,
-        )
-        if not intersections_ellipse(dp_ell_x, dp_ell_y, line):
-            i_disc = np.append(i_disc, i)
+    # An error ellipse misses the concordia when the minimum Mahalanobis
+    # distance from its centre to the curve is beyond the ellipse radius
+    i_in = np.asarray(i_in, dtype=int)
+    xd, yd = np.asarray(xd)[i_in], np.asarray(yd)[i_in]
+    sigma_xd, sigma_yd = np.asarray(sigma_xd)[i_in], np.asarray(sigma_yd)[i_in]
+    rho = np.asarray(cov_xdyd)[i_in] / (sigma_xd * sigma_yd)
+    line = np.asarray(line, dtype=float)
+    d2, _ = minDistance(xd, sigma_xd, yd, sigma_yd, rho, line[:, 0], line[:, 1])
+    i_disc = np.append(i_disc, i_in[~(d2 <= ellipse_scale(conf) ** 2)])
 
     i_disc = np.unique(i_disc)
     i_ind = np.setdiff1d(i_in, i_disc)
@@ -1089,12 +1021,7 @@ def func_t76(t, r):
 
 
 def calc_t76(r76):
-    T = []
-    for i, r in enumerate(r76):
-        t = 1 / l238U * np.log(r + 1)  # initial time for calculation
-        T76 = optimize.leastsq(func_t76, t, args=(r))[0][0]
-        T.append(T76)
-    return T
+    return concordia_table(l238U, l235U, U85r).age76(r76)
 
 
 # ------------------------------------------------
@@ -1132,32 +1059,20 @@ def func_t76diseq(t, r):
 
 
 def calc_t68diseq(R68m):
-    T = []  # corrected age for initial disequilibria
-    for i, r in enumerate(R68m):
-        t = calc_t68(r)  # assumed time for calculation
-        T68 = optimize.leastsq(func_t68diseq, t, args=(r))[0][0]
-        T.append(T68)
-    return T
+    # corrected age for initial disequilibria
+    return concordia_table(l238U, l235U, U85r).age68(R68m, fThU=f_Th_U)
 
 
 def calc_t75diseq(R75m):
-    T = []  # corrected age for initial disequilibria
-    for i, r in enumerate(R75m):
-        t = calc_t75(r)  # assumed time for calculation
-        T75 = optimize.leastsq(func_t75diseq, t, args=(r))[0][0]
-        T.append(T75)
-    return T
+    # corrected age for initial disequilibria
+    return concordia_table(l238U, l235U, U85r).age75(R75m, fPaU=f_Pa_U)
 
 
 def calc_t76diseq(R68m, R76m):
-    T = []  # corrected age for initial disequilibria
-    for i, r in enumerate(R76m):
-        t = calc_t68(R68m[i])  # initial time for calculation
-        T76 = optimize.leastsq(func_t76diseq, t, args=(r))[0][0]
-        if T76 < 0:
-            T76 = 0.0
-        T.append(T76)
-    return T
+    # corrected age for initial disequilibria, on the branch of the 206Pb/238U age
+    ct = concordia_table(l238U, l235U, U85r)
+    t68 = ct.age68(R68m, fThU=f_Th_U)
+    return ct.age76(R76m, fThU=f_Th_U, fPaU=f_Pa_U, t0=t68)
 
 
 # # ------------------------------------------------
@@ -1210,54 +1125,20 @@ def func_Pb76c(t1):
 def func_corPb76c(r68, r75, r76):
     # X = 1 / d["r68"]  <==  238U/206Pb
     # Y = d["r76"]      <== 207Pb/206Pb
-    # y0 = common 207Pb/206Pb at time t1
-    # x1 = measured 238U/206Pb
-    # y1 = measured 207Pb/206Pb
-    # x2 = corrected (radiogenic) 238U/206Pb
-    # y2 = corrected (radiogenic) 207Pb/206Pb
-    xx2 = []  # corrected (radiogenic) 238U/206Pb
-    yy2 = []  # corrected (radiogenic) 207Pb/206Pb
-    yy0 = []  # common 207Pb/206Pb
-    f206p = []  # fraction of common 206Pb
-    T = []  # zircon crystalization age from eq. (5) in Sakata2018GeochemJ
-    X = 1 / r68
-    Y = r76
-    Xtw, Ytw = ConcLineTW(timeall)
-    line_tw = LineString([(Xtw[i], Ytw[i]) for i, j in enumerate(Xtw)])
-    for i, y1 in enumerate(Y):
-        x1 = X[i]
-        t1 = calc_t68(r68[i])
-        if opt_correct_disequilibrium:
-            t1 = optimize.leastsq(func_t68diseq, t1, args=(r68[i]))[0][0]
-        Pb76c0 = func_Pb76c(t1)
-        x0 = 0
-        y0 = Pb76c0
-        # Y = a x + b
-        # a = delta(207Pb/206Pb)/delta(238U/206Pb)
-        a = (y1 - y0) / (x1 - x0)
-        b = y1 - a * x1
-        x3 = -b / a
-        line1 = LineString([[x0, y0], [x3, 0]])
-        res1 = line1.intersection(line_tw)
-
-        if res1.geom_type == "Point":
-            x2 = res1.x
-            y2 = res1.y
-        elif res1.geom_type == "MultiPoint":
-            x2 = res1[1].x
-            y2 = res1[1].y
-        else:
-            print("More than 2 points?")
-        f = (y1 - y2) / (y0 - y2) * 100
-
-        xx2.append(1 / x2)
-        yy2.append(y2)
-        yy0.append(y0)
-        f206p.append(f)
-        # T.append(t68c)
+    # Projection from the Stacey-Kramers common 207Pb/206Pb at the corrected
+    # age through (X, Y) onto the TW concordia, for all grains at once
+    # (the concordia with initial disequilibria if opt_correct_disequilibrium)
+    if opt_correct_disequilibrium:
+        fThU, fPaU = f_Th_U, f_Pa_U
+    else:
+        fThU, fPaU = 1, 1
+    c = correct207(
+        1 / np.asarray(r68), 0, np.asarray(r76), 0,
+        l238U=l238U, l235U=l235U, U85r=U85r, fThU=fThU, fPaU=fPaU
+    )
 
-    # return corrected R68cor, R76cor, f206%
-    return (xx2, yy2, yy0, f206p)
+    # return corrected R68cor, R76cor, common R76, f206%
+    return (1 / c["X"], c["Y"], c["y0"], c["f206"])
 
 
 # ------------------------------------------------
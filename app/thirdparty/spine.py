@@ -14,17 +14,21 @@ standard = [screen]   # default where print goes
 def nmad(e):
     return 1.4826 * np.median(np.absolute(e - np.median(e)))
 
-def siegel(data): # siegel (1982)
-    n = data.shape[0];  
+def siegel(data, maxblock=2**20): # siegel (1982)
+#   repeated median line; the pairwise slopes are built maxblock elements at a
+#   time and pairs tied in x are left out of the medians (data is not changed)
+    n = data.shape[0]
     (x, sdx, y, sdy, cor) = np.transpose(data)
-    x += 1e-8 * np.random.random(n) # naive breaking of x ties
-    med = np.empty(n);  
-    for i in range(n):
-        col = np.empty(n);  
-        for j in range(n):
-            if i is not j: col[j] = (y[j] - y[i])/(x[j] - x[i])
-        med[i] = np.median(np.delete(col, i)) 
-    b = np.median(med)
+    rows = max(1, maxblock // n)
+    med = np.empty(n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i in range(0, n, rows):
+            k = np.arange(i, min(i + rows, n))
+            dx = x[None, :] - x[k, None]
+            slopes = (y[None, :] - y[k, None])/dx
+            slopes[dx == 0] = np.nan                 # includes j == i
+            med[k] = np.nanmedian(slopes, axis=1)
+    b = np.nanmedian(med)
     return np.array((np.median(y - x * b), b))
 
 # ------------------------------------------------------
@@ -51,39 +55,82 @@ def calcage(theta, covtheta = None, method = 1):
 
 # ------------------------------------------------------
 
-def huber2(data0, h = 1.4):
-#   huber line-fitter
-    n = data0.shape[0]
+def huber2(data0, h = 1.4, theta0 = None, trace = False):
+#   huber line-fitter for a single dataset, see huberBatch
+    return huberBatch([data0], h, None if theta0 is None else [theta0], trace)[0]
+
+def huberBatch(datas, h = 1.4, theta0 = None, trace = False):
+#   huber line-fitter for many datasets in one call
+#   datas: list of (n, 5) arrays of x, sdx, y, sdy, cor
+#   theta0: optional list of (a, b) starting values, e.g. a previous fit
+#   returns a (code, theta, covtheta, sump, k, smin) tuple per dataset, plus
+#   the list of step sizes per iteration if trace
+    m = len(datas)
     itmax = 2000; mindel = 1e-15; mincond = 1e-12; minsump = 0.01
-    (x, sdx, y, sdy, cor) = np.transpose(data0)
-    avx = np.dot(x, np.ones(n))/n;  avy = np.dot(y, np.ones(n))/n;
-    div = np.array([1/avy, avx/avy])
-    data = np.copy(data0)
+    n = np.array([d.shape[0] for d in datas])
+    seg = np.concatenate(([0], np.cumsum(n)[:-1]))
+    ssum = lambda v: np.add.reduceat(v, seg)
+    rep = lambda v: np.repeat(v, n)
+    data = np.concatenate(datas).astype(float)
     (x, sdx, y, sdy, cor) = np.transpose(data)
-    x /= avx; sdx /= avx; y /= avy; sdy /= avy; cov = sdx*sdy*cor
-    theta = siegel(data);                            
-    k = 0; code = 0; deltheta = (1e10, 1e10)
-    while k < itmax and ( np.sqrt(np.dot(deltheta,deltheta)) > mindel): 
-        k += 1; (a, b) = oldtheta = theta
+    avx = ssum(x)/n;  avy = ssum(y)/n
+    div = np.transpose([1/avy, avx/avy])
+    x /= rep(avx); sdx /= rep(avx); y /= rep(avy); sdy /= rep(avy); cov = sdx*sdy*cor
+    if theta0 is None:
+        theta = np.array([siegel(data[s:s + k]) for s, k in zip(seg, n)])
+    else:
+        theta = np.array(theta0, dtype=float).reshape(m, 2) * div
+
+    def step(theta):
+        a = rep(theta[:, 0]); b = rep(theta[:, 1])
         e = a + b * x - y;  sde = np.sqrt(b**2*sdx**2 - 2*b*cov + sdy**2)
         r = e/sde
-        wh = [1 if abs(rk) < h else np.sqrt(h/abs(rk)) for rk in r]/sde
+        wh = np.sqrt(h/np.maximum(np.abs(r), h))/sde   # huber weights
         xp = x - r * (b*sdx**2 - cov)/sde            # x on the line
         ypp = (y - e - r*(b*cov - sdy**2)/sde)*wh    # W^(1/2)(y'-e): y off the line
-        c = np.transpose([wh, xp*wh])                # W^(1/2) X'
-        (u, s, v) = np.linalg.svd(c, full_matrices=False)
-        if mincond * s[0] > s[1]: code = -1; break   # (nearly) singular matrix
-        theta = np.dot(np.dot(np.dot(np.transpose(v), np.diag(1/s)), np.transpose(u)), ypp)
-        deltheta = theta - oldtheta   
-        print(deltheta)
-    if k == itmax: code = 1  # not converged
-    pc = np.dot([wh**2, xp*wh**2], e);
-    sump = np.sqrt(np.dot(pc, pc));     
-    if sump > minsump: code = 2  # not solved the nle
-    dpsi = [1 if abs(rk) < h else 0 for rk in r] 
-    covtheta = np.linalg.inv(np.dot(np.dot(np.transpose(c), np.diag(dpsi)), c)) / \
-        np.array([[div[0]**2, div[0] * div[1]], [div[0] * div[1], div[1]**2]])
-    return (code, theta/div, covtheta, sump, k, s[1])
+        return (e, r, wh, xp, ypp)
+
+    k = np.zeros(m, dtype=int); code = np.zeros(m, dtype=int)
+    smin = np.zeros(m); active = np.ones(m, dtype=bool)
+    oldtheta = theta.copy(); steps = [[] for i in range(m)]
+    while active.any():
+        k[active] += 1; oldtheta[active] = theta[active]
+        (e, r, wh, xp, ypp) = step(theta)
+        # normal equations of W^(1/2) X' theta = W^(1/2)(y'-e), solved as 2x2
+        # for the change in theta so rounding scales with the step size
+        u = ypp - wh*(rep(theta[:, 0]) + rep(theta[:, 1])*xp)
+        s11 = ssum(wh**2); s12 = ssum(xp*wh**2); s22 = ssum(xp**2*wh**2)
+        t1 = ssum(wh*u); t2 = ssum(xp*wh*u)
+        det = s11*s22 - s12**2
+        hw = np.sqrt(np.maximum((s11 - s22)**2/4 + s12**2, 0))
+        s0 = np.sqrt((s11 + s22)/2 + hw)
+        s1 = np.sqrt(np.maximum((s11 + s22)/2 - hw, 0))
+        smin[active] = s1[active]
+        singular = active & (mincond * s0 > s1)   # (nearly) singular matrix
+        code[singular] = -1; active &= ~singular
+        new = theta + np.transpose([(s22*t1 - s12*t2)/det, (s11*t2 - s12*t1)/det])
+        theta[active] = new[active]
+        deltheta = np.sqrt(np.sum((theta - oldtheta)**2, axis=1))
+        if trace:
+            for i in np.flatnonzero(active): steps[i].append(deltheta[i])
+        active &= (k < itmax) & (deltheta > mindel)
+    code[k == itmax] = 1  # not converged
+
+    (e, r, wh, xp, ypp) = step(oldtheta)
+    pc = np.transpose([ssum(wh**2*e), ssum(xp*wh**2*e)])
+    sump = np.sqrt(np.sum(pc**2, axis=1))
+    code[sump > minsump] = 2  # not solved the nle
+    dpsi = np.abs(r) < h
+    c11 = ssum(dpsi*wh**2); c12 = ssum(dpsi*xp*wh**2); c22 = ssum(dpsi*xp**2*wh**2)
+    # inverted with np.linalg.inv as in the single-dataset fitter, the closed
+    # form 2x2 inverse loses digits to cancellation in the determinant
+    covs = np.linalg.inv(np.transpose([[c11, c12], [c12, c22]], (2, 0, 1)))
+    res = []
+    for i in range(m):
+        covtheta = covs[i] / np.outer(div[i], div[i])
+        fit = (code[i], theta[i]/div[i], covtheta, sump[i], k[i], smin[i])
+        res.append(fit + (steps[i],) if trace else fit)
+    return res
 
 # ------------------------------------------------------
 
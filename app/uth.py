@@ -0,0 +1,235 @@
+'''
+U-Th disequilibrium calculations.
+
+The 230Th ages here solve every analysis of a dataset at once and propagate
+the activity ratio errors with analytic derivatives instead of carrying
+uncertainties objects through the iteration. The decay constants are per
+year, as in Isoplot's Th230age.
+'''
+
+import numpy as np
+from app.datatypes import Columns
+
+l230 = 9.15771e-06
+l234 = 2.82629e-06
+
+
+def k1(t, l0, l4):
+    return (1 - np.exp((l4-l0)*t))*l0/(l4-l0)
+
+
+def U234U238(t, U234U238_0):
+    l4 = 0.00282206
+    return 1 + (U234U238_0 - 1)*np.exp(-l4*t)
+
+
+def Th230U238(t, U234U238_0):
+    l4 = 0.00282206
+    l0 = 0.0091705
+    a = U234U238(t, U234U238_0)
+    return 1 - np.exp(-l0*t) - (a - 1)*k1(t, l0, l4)
+
+
+def nanJoin(x, y):
+    ''' Flattens rows of curves into one array pair with NaN between rows '''
+    pad = np.full((x.shape[0], 1), np.nan)
+    return (np.hstack((x, pad)).ravel()[:-1], np.hstack((y, pad)).ravel()[:-1])
+
+
+def evolutionGrid(t_min, t_max, t_step, a_min, a_max, a_step, n=100):
+    ''' Isochron (time) and initial 234U/238U lines of the U-Th evolution
+        diagram, with t in ka
+
+        Every family is evaluated in one go on a (lines x n) grid and returned
+        as a single NaN separated curve.
+
+        Returns:
+        dict: 'times' and 'activities' of the lines, 'time' and 'activity'
+        (x, y) curves and 'labels', the (x, y) end of each time line
+    '''
+    tt = np.arange(t_min, t_max + 0.01, t_step)
+    aa = np.arange(a_min, a_max + 0.001, a_step)
+    ttt = np.linspace(t_min, t_max, n)
+    aaa = np.linspace(a_min, a_max, n)
+
+    tx = Th230U238(tt[:, None], aaa[None, :])
+    ty = U234U238(tt[:, None], aaa[None, :])
+    ax = Th230U238(ttt[None, :], aa[:, None])
+    ay = U234U238(ttt[None, :], aa[:, None])
+
+    return {
+        'times': tt,
+        'activities': aa,
+        'time': nanJoin(tx, ty),
+        'activity': nanJoin(ax, ay),
+        'labels': (tx[:, -1], ty[:, -1])
+    }
+
+
+def ageDerivatives(t, U234U238):
+    ''' Derivatives of the 230Th age t (years) with respect to the 230Th/238U
+        and 234U/238U activity ratios '''
+    L = l230/(l230 - l234)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        a = np.exp(-l230*t)
+        b = np.exp(-(l230 - l234)*t)
+        drdt = l230*(a + (U234U238 - 1)*b)
+        return (1/drdt, -L*(1 - b)/drdt)
+
+
+def Th230ageN(Th230U238, Th230U238_err, U234U238, U234U238_err, corr, tol=1e-12, maxiter=50):
+    ''' 230Th ages and initial 234U/238U for arrays of activity ratios
+
+        Newton's method is applied to all rows together, with rows that have
+        converged left alone. The errors come from the implicit derivatives
+        of the age equation at the solution, including the 230Th/238U vs
+        234U/238U error correlation.
+
+        Parameters:
+        Th230U238, U234U238 (array): activity ratios
+        Th230U238_err, U234U238_err (array): their 1 sigma errors
+        corr (array): their error correlation
+
+        Returns:
+        dict: 'age' and 'age err' in ka, 'U234U238_0' and 'U234U238_0 err'
+        (initial 234U/238U), their error correlation 'rho' and 'converged'.
+        Rows without a solution are NaN.
+    '''
+    R = np.asarray(Th230U238, dtype=float)
+    sR = np.asarray(Th230U238_err, dtype=float)
+    U = np.asarray(U234U238, dtype=float)
+    sU = np.asarray(U234U238_err, dtype=float)
+    rho = np.asarray(corr, dtype=float)
+    L = l230/(l230 - l234)
+
+    t = np.full(R.shape, 5000.0)
+    converged = np.zeros(R.shape, dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        for _ in range(maxiter):
+            a = np.exp(-l230*t)
+            b = np.exp(-(l230 - l234)*t)
+            r = 1 - a + (U - 1)*L*(1 - b)
+            delta = (r - R)/(l230*(a + (U - 1)*b))
+            delta = np.where(converged, 0, delta)
+            t = t - delta
+            converged |= np.abs(delta) <= tol*np.abs(t)
+            if converged.all():
+                break
+
+        t = np.where(converged & np.isfinite(t), t, np.nan)
+        dtdR, dtdU = ageDerivatives(t, U)
+        var_t = dtdR**2*sR**2 + dtdU**2*sU**2 + 2*dtdR*dtdU*rho*sR*sU
+
+        e4 = np.exp(l234*t)
+        U0 = 1 + (U - 1)*e4
+        dU0dR = (U - 1)*l234*e4*dtdR
+        dU0dU = e4 + (U - 1)*l234*e4*dtdU
+        var_U0 = dU0dR**2*sR**2 + dU0dU**2*sU**2 + 2*dU0dR*dU0dU*rho*sR*sU
+        cov = dtdR*dU0dR*sR**2 + dtdU*dU0dU*sU**2 + (dtdR*dU0dU + dtdU*dU0dR)*rho*sR*sU
+
+    return {
+        'age': t/1000,
+        'age err': np.sqrt(var_t)/1000,
+        'U234U238_0': U0,
+        'U234U238_0 err': np.sqrt(var_U0),
+        'rho': cov/np.sqrt(var_t*var_U0),
+        'converged': converged
+    }
+
+
+def Th230ages(df):
+    ''' Th230ageN for a U-Th dataset, as columns indexed like df '''
+    import pandas as pd
+
+    res = Th230ageN(
+        df[Columns.Th230_U238], df[Columns.Th230_U238_err],
+        df[Columns.U234_U238], df[Columns.U234_U238_err],
+        df[Columns.U234_U238_Th230_U238_corr]
+    )
+    return pd.DataFrame({
+        Columns.Th230_age: res['age'],
+        Columns.Th230_age_err: res['age err'],
+        Columns.U234_U238_initial: res['U234U238_0'],
+        Columns.U234_U238_initial_err: res['U234U238_0 err']
+    }, index=df.index)
+
+
+def _column(df, col, default=0.0):
+    return np.asarray(df[col], dtype=float) if col in df else default
+
+
+def detritalCorrection(df, ratio, ratio_err, decay=True, l0=(0.0091705, 0.0000016)):
+    ''' Removes detrital 230Th from the 230Th/238U activity ratios of df
+
+        The detrital 230Th/238U is ratio * 232Th/238U, decayed over the
+        (uncorrected) 230Th age of each analysis if decay is True. Errors are
+        propagated to first order from the measured ratios (with all their
+        correlations), the detrital ratio and, if decay, the 230Th decay
+        constant l0 (per ka).
+
+        Returns:
+        DataFrame: a copy of df with corrected 230Th/238U, its error and its
+        error correlations with 234U/238U and 232Th/238U
+    '''
+    R = np.asarray(df[Columns.Th230_U238], dtype=float)
+    sR = np.asarray(df[Columns.Th230_U238_err], dtype=float)
+    U = np.asarray(df[Columns.U234_U238], dtype=float)
+    sU = np.asarray(df[Columns.U234_U238_err], dtype=float)
+    Th = np.asarray(df[Columns.Th232_U238], dtype=float)
+    sTh = np.asarray(df[Columns.Th232_U238_err], dtype=float)
+    rRU = _column(df, Columns.U234_U238_Th230_U238_corr)
+    rThR = _column(df, Columns.Th232_U238_Th230_U238_corr)
+    rThU = _column(df, Columns.Th232_U238_U234_U238_corr)
+    (l, sl) = l0
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if decay:
+            res = Th230ageN(R, sR, U, sU, rRU)
+            t = res['age']
+            dtdR, dtdU = [d/1000 for d in ageDerivatives(1000*t, U)]
+            E = np.exp(-l*t)
+        else:
+            t = dtdR = dtdU = 0
+            E = 1
+
+        K = ratio*E
+        gR = 1 + K*Th*l*dtdR
+        gU = K*Th*l*dtdU
+        gTh = -K
+        gD = -Th*E
+        gl = K*Th*t if decay else 0
+
+        covRU = rRU*sR*sU
+        covRTh = rThR*sR*sTh
+        covUTh = rThU*sU*sTh
+        var = (gR**2*sR**2 + gU**2*sU**2 + gTh**2*sTh**2
+               + 2*(gR*gU*covRU + gR*gTh*covRTh + gU*gTh*covUTh)
+               + gD**2*ratio_err**2 + gl**2*sl**2)
+        err = np.sqrt(var)
+
+        out = df.copy()
+        out[Columns.Th230_U238] = R - K*Th
+        out[Columns.Th230_U238_err] = err
+        out[Columns.U234_U238_Th230_U238_corr] = (gR*covRU + gU*sU**2 + gTh*covUTh)/(err*sU)
+        out[Columns.Th232_U238_Th230_U238_corr] = (gR*covRTh + gU*covUTh + gTh*sTh**2)/(err*sTh)
+
+    return out
+
+
+def isochronCorrection(df, model='York'):
+    ''' detritalCorrection with the detrital ratio from an isochron
+
+        230Th/238U is fitted against 232Th/238U and the slope, the detrital
+        230Th/232Th as it is today, is removed from every analysis.
+    '''
+    from app.math import fitLine
+
+    fit = fitLine(
+        np.asarray(df[Columns.Th232_U238], dtype=float),
+        np.asarray(df[Columns.Th232_U238_err], dtype=float),
+        np.asarray(df[Columns.Th230_U238], dtype=float),
+        np.asarray(df[Columns.Th230_U238_err], dtype=float),
+        _column(df, Columns.Th232_U238_Th230_U238_corr, np.zeros(len(df))),
+        model=model
+    )
+    return detritalCorrection(df, fit['m'], fit['sigma_m'], decay=False)
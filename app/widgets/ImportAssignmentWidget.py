@@ -5,6 +5,7 @@ from PySide2.QtCore import Qt, QSettings
 from app.models.pandasmodel import PandasImportModel, PandasImportProxyModel
 from app.delegates.columnsdelegate import ColumnsDelegate
 from app.datatypes import DataTypes, Columns
+from app import derived
 
 def convert_errors(df, error_type):
     error_value_pars = {v: k for k, v in Columns.value_error_pairs.items()}
@@ -33,45 +34,10 @@ def convert_errors(df, error_type):
     return df
 
 
-def meas_rho(x, xe, u, ue, v, ve):
-    return ((ue / u) ** 2 + (ve / v) ** 2 - (xe / x) ** 2) / (2 * (ue / u) * (ve / v))
-
-
 def compute_dependents(df):
-    # Add 238U/206Pb if it doesn't exist
-    if Columns.U238_Pb206 not in df.columns and Columns.Pb206_U238 in df.columns:
-        df[Columns.U238_Pb206] = 1 / df[Columns.Pb206_U238]
-        df[Columns.U238_Pb206_err] = df[Columns.U238_Pb206] * (df[Columns.Pb206_U238_err] / df[Columns.Pb206_U238])
-
-    # Add calculated error correlation of 6/38 and 7/35
-    requirements = [Columns.Pb206_U238, Columns.Pb206_U238_err,
-                    Columns.Pb207_U235, Columns.Pb207_U235_err,
-                    Columns.Pb207_Pb206, Columns.Pb207_Pb206_err]
-
-    if Columns.WetherillErrorCorrelation not in df.columns and set(requirements).issubset(df.columns):
-        df[Columns.WetherillErrorCorrelation] = meas_rho(df[Columns.Pb207_Pb206], df[Columns.Pb207_Pb206_err],
-                                                         df[Columns.Pb207_U235], df[Columns.Pb207_U235_err],
-                                                         df[Columns.Pb206_U238], df[Columns.Pb206_U238_err])
-
-    # Add calculated error correlation of 7/6 and 38/6
-    requirements = [Columns.U238_Pb206, Columns.U238_Pb206_err,
-                    Columns.Pb207_Pb206, Columns.Pb207_Pb206_err,
-                    Columns.Pb207_U235, Columns.Pb207_U235_err]
-
-    if Columns.TWErrorCorrelation not in df.columns and set(requirements).issubset(df.columns):
-        df[Columns.TWErrorCorrelation] = meas_rho(df[Columns.Pb207_U235], df[Columns.Pb207_U235_err],
-                                                  df[Columns.U238_Pb206], df[Columns.U238_Pb206_err],
-                                                  df[Columns.Pb207_Pb206], df[Columns.Pb207_Pb206_err])
-
-    if Columns.Rb87_Sr86 not in df.columns and Columns.Sr87_Sr86 in df.columns:
-        ab87Rb = 0.2783
-        ab86Sr = 0.0986
-
-        df[Columns.Rb87_Sr86] = ab87Rb*df[Columns.RbConc]/(ab86Sr*df[Columns.SrConc])
-        df[Columns.Rb87_Sr86_err] = 0.02*df[Columns.Rb87_Sr86]
-
-
-    return df
+    # Add the columns (inverse ratios, error correlations, ages, ...) that can
+    # be computed from the assigned ones, see app.derived for the rules
+    return derived.compute(df)
 
 
 def available_data_types(df):
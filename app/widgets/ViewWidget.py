@@ -7,6 +7,7 @@ from app import preferences
 import numpy as np
 from app.data import datasets
 from app.dispatch import dispatch
+from app.cache import results
 import pandas as pd
 '''
 NOTE:
@@ -58,6 +59,9 @@ class ViewWidget(QWidget):
             # If the whole plottable represents a measurement (e.g. error ellipse)
             if pl.property('dataIndex'):
                 di = pl.property('dataIndex')
+            # If the plottable batches several measurements (e.g. ellipses drawn as points)
+            elif pl.property('dataIndices'):
+                di = pl.property('dataIndices')[di]
 
             m = QMenu()
             m.addAction('Delete data point', lambda: self.deletePoint(di))
@@ -67,8 +71,18 @@ class ViewWidget(QWidget):
 
     def deletePoint(self, di):
         datasets[self.dsname].drop(di, axis='index', inplace=True)
+        results.invalidate(self.dsname)
+        updated = self.pointDeleted(di)
         dispatch.datasetsChanged.emit()
-        self.addDataset(self.dsname)
+        if not updated:
+            self.addDataset(self.dsname)
+
+    def pointDeleted(self, di):
+        ''' Called with the index of a point dropped from the current dataset.
+            Views that can update themselves without rebuilding everything
+            (e.g. by taking the point out of their WeightedMeanStats) override
+            this and return True, otherwise the dataset is added again. '''
+        return False
 
     def movePoint(self, di, preserve=False):
 
@@ -80,6 +94,7 @@ class ViewWidget(QWidget):
             datasets[newname] = pd.DataFrame(columns=datasets[self.dsname].columns)
 
         datasets[newname].loc[di] = datasets[self.dsname].loc[di]
+        results.invalidate(newname)
 
         if not preserve:
             self.deletePoint(di)